@@ -0,0 +1,397 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Scale benchmark for the ochopod control plane. This script simulates N pods in one single process, each running
+its coordinator, the reactive model (when leading) and a no-op piped life-cycle. Zookeeper is emulated in-memory and
+the control requests sent by the leader are routed in-process to the life-cycle actors (which is what the /control
+endpoint would do).
+
+The following scenarios are run in order against a main cluster depending on a small one :
+
+    - cold start : boot all the pods and wait for the main cluster to be configured
+    - leader kill : kill the leader and wait for a new one to re-configure the cluster
+    - churn : replace 10% of the pods and wait for the cluster to be re-configured
+    - dependency flap : kill & replace one pod of the dependency and wait for the cluster to be re-configured
+
+For each scenario we report how long it took, the leader gap (when the leader is killed), the zookeeper operations,
+the control requests, the peak RSS and the thread count. The state-machines use the shared timer unless --threads is
+set. Just run "python cluster.py --pods 1000" for instance.
+"""
+
+import json
+import logging
+import resource
+import time
+
+from argparse import ArgumentParser
+from ochopod.core import core
+from ochopod.core.codec import CODECS, JSON
+from ochopod.core.emulator import Ensemble
+from ochopod.core.fsm import share_timer, shutdown
+from ochopod.core.hints import Hints
+from ochopod.core.snapshot import Reader
+from ochopod.models.piped import Actor as Piped
+from ochopod.models.reactive import Actor as Reactive
+from pykka import ThreadingFuture
+from pykka.exceptions import ActorDeadError, Timeout
+from threading import active_count, Lock, Thread
+
+#: Life-cycle actor of each simulated pod, indexed by control URL.
+ROUTES = {}
+
+#: Number of control requests sent so far, per task.
+CALLS = {}
+
+#: Lock protecting the control request counters.
+_lock = Lock()
+
+
+class Routed(Thread):
+    """
+    Drop-in replacement for the HTTP transport used by the reactive model. The control request is delivered to the
+    life-cycle actor of the target pod (the payload is still encoded).
+    """
+
+    def __init__(self, key, url, js=None, timeout=60.0, codec=JSON, done=None):
+        super(Routed, self).__init__()
+
+        self.code = None
+        self.codec = codec
+        self.done = done
+        self.js = js
+        self.key = key
+        self.timeout = timeout
+        self.url = url
+
+    def run(self):
+
+        try:
+            self._deliver()
+
+        finally:
+            if self.done:
+                self.done((self.key, self.code))
+
+    def _deliver(self):
+
+        #
+        # - the URL looks like http://<ip>:<port>/control/<task>/<timeout>
+        # - an unknown pod is unreachable (e.g no HTTP code)
+        #
+        base, _, task, _ = self.url.rsplit('/', 3)
+        with _lock:
+            CALLS[task] = CALLS.get(task, 0) + 1
+
+        executor = ROUTES.get(base)
+        if not executor:
+            return
+
+        try:
+            latch = ThreadingFuture()
+            data = self.codec.encode(self.js)
+            executor.tell({'request': task, 'latch': latch, 'data': data, 'type': self.codec.content_type})
+            _, self.code = latch.get(timeout=self.timeout)
+
+        except Timeout:
+            self.code = 408
+
+        except ActorDeadError:
+            self.code = 410
+
+    def join(self, timeout=None):
+
+        Thread.join(self)
+        return self.key, self.code
+
+
+class Noop(Piped):
+    """
+    Life-cycle that configures without ever starting anything (the pods are booted with $ochopod_start=false).
+    """
+
+    def configure(self, cluster):
+        return 'true', {}
+
+
+class Pod(object):
+    """
+    One simulated pod : its hints, coordinator and life-cycle actor.
+    """
+
+    #: Counter used to allocate unique IPs.
+    allocated = 0
+
+    def __init__(self, cluster, model):
+
+        Pod.allocated += 1
+        ip = '10.%d.%d.%d' % ((Pod.allocated >> 16) & 255, (Pod.allocated >> 8) & 255, Pod.allocated & 255)
+        self.hints = Hints(
+            {
+                'application': cluster,
+                'cluster': cluster,
+                'debug': 'false',
+                'fwk': 'benchmark',
+                'ip': ip,
+                'local': 'false',
+                'namespace': 'benchmark',
+                'node': 'node-%d' % Pod.allocated,
+                'port': '8080',
+                'ports': {'8080': 8080},
+                'public': ip,
+                'start': 'false',
+                'task': 'task-%d' % Pod.allocated,
+                'zk': 'emulated'
+            })
+
+        #
+        # - boot the pod like the marathon binding would
+        #
+        _, breadcrumbs = self.hints.snapshot()
+        breadcrumbs['codecs'] = sorted(CODECS.keys())
+        self.hints.update({'metrics': {}, 'dependencies': model.depends_on})
+        self.url = 'http://%s:8080' % ip
+        self.executor = Noop.start({}, ThreadingFuture(), self.hints)
+        ROUTES[self.url] = self.executor
+        self.coordinator = core.Coordinator.start(['emulated'], 'benchmark', cluster, 8080, breadcrumbs, model,
+                                                  self.hints)
+
+    def kill(self):
+
+        del ROUTES[self.url]
+        shutdown(self.coordinator)
+        shutdown(self.executor)
+
+    def electing(self):
+
+        return self.hints.get('state', '').startswith('leader')
+
+    def leading(self):
+
+        return self.hints.get('state') == 'leader'
+
+
+def _model(dependencies, damper, damper_max=0.0, incremental=False):
+
+    class Model(Reactive):
+
+        depends_on = dependencies
+
+        transport = Routed
+
+    Model.damper = damper
+    Model.damper_max = damper_max
+    Model.incremental = incremental
+    return Model
+
+
+def _wait(predicate, timeout):
+
+    ts = time.time()
+    while time.time() - ts < timeout:
+        if predicate():
+            return time.time() - ts
+        time.sleep(0.01)
+
+    return None
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='ochopod control plane scale benchmark')
+    parser.add_argument('--pods', type=int, default=100, help='number of pods in the main cluster')
+    parser.add_argument('--dependencies', type=int, default=3, help='number of pods in the dependency cluster')
+    parser.add_argument('--churn', type=float, default=0.1, help='fraction of pods replaced by the churn scenario')
+    parser.add_argument('--damper', type=float, default=1.0, help='reactive damper in seconds')
+    parser.add_argument('--damper-max', type=float, default=0.0, help='adaptive damper cap in seconds (off if 0)')
+    parser.add_argument('--incremental', action='store_true', help='only configure the pods whose inputs changed')
+    parser.add_argument('--latency', type=float, default=0.0, help='emulated zookeeper latency in seconds')
+    parser.add_argument('--timeout', type=float, default=600.0, help='scenario timeout in seconds')
+    parser.add_argument('--threads', action='store_true', help='use one thread per delayed transition')
+    parser.add_argument('--json', action='store_true', help='output the report as json')
+    parser.add_argument('--debug', action='store_true', help='turn the ochopod logs on')
+    args = parser.parse_args()
+
+    logging.getLogger('ochopod').setLevel(logging.DEBUG if args.debug else logging.CRITICAL)
+    if not args.threads:
+        share_timer()
+
+    #
+    # - route our zookeeper clients to the emulator
+    # - use one extra client to observe what the leaders write
+    #
+    ensemble = Ensemble(latency=args.latency)
+    core.FACTORY = ensemble.client
+    observer = ensemble.client()
+    observer.start()
+    reader = Reader(observer)
+
+    models = \
+        {
+            'db': _model([], args.damper, args.damper_max, args.incremental),
+            'web': _model(['db'], args.damper, args.damper_max, args.incremental)
+        }
+    clusters = {'db': [], 'web': []}
+
+    def _snapshot(cluster):
+
+        pods = reader.read('%s/benchmark.%s' % (core.ROOT, cluster))
+        return set(js['ip'] for js in pods.values()) if pods else set()
+
+    def _hash(cluster):
+
+        try:
+            value, _ = observer.get('%s/benchmark.%s/hash' % (core.ROOT, cluster))
+            return value
+
+        except Exception:
+            return None
+
+    def _configured(cluster):
+
+        #
+        # - the cluster is configured once its leader is idle and its snapshot lists all our pods
+        #
+        pods = clusters[cluster]
+        leading = any(pod.leading() for pod in pods)
+        return leading and _snapshot(cluster) == set(pod.hints['ip'] for pod in pods)
+
+    def _boot(cluster, n):
+
+        clusters[cluster] += [Pod(cluster, models[cluster]) for _ in range(n)]
+
+    def _kill(cluster, pods):
+
+        #
+        # - kill the pods concurrently (a follower may take a while to give up its lock)
+        #
+        threads = [Thread(target=pod.kill) for pod in pods]
+        for pod, thread in zip(pods, threads):
+            clusters[cluster].remove(pod)
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    report = []
+
+    def _run(name, action, predicate, leader=None):
+
+        #
+        # - snapshot our counters, run the scenario and wait until it completes
+        # - if the scenario removes the leader of a cluster, measure the leader gap from a separate thread started
+        #   before the kill (e.g until one of the surviving pods is electing)
+        #
+        ops = sum(ensemble.stats()['ops'].values())
+        with _lock:
+            calls = dict(CALLS)
+
+        gap = [None]
+        if leader:
+            victims = [pod for pod in clusters[leader] if pod.electing()]
+
+            def _elected():
+                return any(pod.electing() for pod in list(clusters[leader]) if pod not in victims)
+
+            def _probe():
+                gap[0] = _wait(_elected, args.timeout)
+
+            probe = Thread(target=_probe)
+            probe.start()
+
+        ts = time.time()
+        action()
+        if leader:
+            probe.join()
+
+        lapse = _wait(predicate, args.timeout)
+        elapsed = time.time() - ts
+        total = sum(ensemble.stats()['ops'].values()) - ops
+        with _lock:
+            sent = {task: count - calls.get(task, 0) for task, count in CALLS.items() if count > calls.get(task, 0)}
+
+        report.append(
+            {
+                'scenario': name,
+                'configured (s)': round(elapsed, 2) if lapse is not None else None,
+                'leader gap (s)': round(gap[0], 2) if gap[0] is not None else None,
+                'zk ops': total,
+                'zk ops/s': round(total / elapsed, 1),
+                'control calls': sent,
+                'peak rss (MB)': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+                'threads': active_count()
+            })
+
+    try:
+
+        #
+        # - cold start : boot the dependency first, then the main cluster
+        #
+        def _cold():
+            _boot('db', args.dependencies)
+            _boot('web', args.pods)
+
+        _run('cold start', _cold, lambda: _configured('db') and _configured('web'))
+
+        #
+        # - leader kill
+        #
+        def _leader():
+            _kill('web', [pod for pod in clusters['web'] if pod.electing()])
+
+        _run('leader kill', _leader, lambda: _configured('web'), leader='web')
+
+        #
+        # - churn : replace a fraction of the followers
+        #
+        def _churn():
+            n = max(1, int(args.pods * args.churn))
+            _kill('web', [pod for pod in clusters['web'] if not pod.electing()][:n])
+            _boot('web', n)
+
+        _run('churn', _churn, lambda: _configured('web'))
+
+        #
+        # - dependency flap : replace one follower of the dependency
+        # - the main cluster must re-configure (its hash depends on its dependencies)
+        #
+        last = [_hash('web')]
+
+        def _flap():
+            last[0] = _hash('web')
+            _kill('db', [pod for pod in clusters['db'] if not pod.electing()][:1])
+            _boot('db', 1)
+
+        _run('dependency flap', _flap, lambda: _configured('db') and _configured('web') and _hash('web') != last[0])
+
+    finally:
+
+        for cluster, pods in clusters.items():
+            _kill(cluster, list(pods))
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+
+    else:
+        print('%d pods (+%d dependencies), damper %2.1f s, zk latency %d ms' %
+              (args.pods, args.dependencies, args.damper, int(args.latency * 1000)))
+        for js in report:
+            unrolled = ', '.join('%s=%d' % (task, count) for task, count in sorted(js['control calls'].items()))
+            gap = '%s s' % js['leader gap (s)'] if js['leader gap (s)'] is not None else 'n/a'
+            print('- %-16s configured in %s s, leader gap %s, %d zk ops (%s/s), %s, %s MB peak, %d threads' %
+                  (js['scenario'], js['configured (s)'], gap, js['zk ops'], js['zk ops/s'],
+                   unrolled or 'no control calls', js['peak rss (MB)'], js['threads']))
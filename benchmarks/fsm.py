@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Micro-benchmark measuring how many state transitions per second our state-machines can sustain. Each actor loops
+through two states without any delay (which is what a spin loop or a watcher does) and stops after a fixed number
+of transitions. The actors run concurrently. Just run "python fsm.py --actors 4 --transitions 100000" for instance.
+"""
+
+import json
+import logging
+import time
+
+from argparse import ArgumentParser
+from ochopod.core import trace
+from ochopod.core.fsm import FSM, Latch, wait_all
+
+
+class Loop(FSM):
+    """
+    State-machine ping-ponging between two states until it reaches its transition count.
+    """
+
+    def __init__(self, latch, transitions):
+        super(Loop, self).__init__()
+
+        self.latches.append(latch)
+        self.path = 'loop'
+        self.transitions = transitions
+
+    def initial(self, data):
+
+        data.count = 0
+        data.since = time.time()
+        return 'ping', data, 0
+
+    def ping(self, data):
+
+        data.count += 1
+        return 'pong', data, 0
+
+    def pong(self, data):
+
+        data.count += 1
+        if data.count >= self.transitions:
+            self.exitcode(time.time() - data.since)
+
+        return 'ping', data, 0
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='ochopod state-machine throughput benchmark')
+    parser.add_argument('--actors', type=int, default=1, help='number of concurrent state-machines')
+    parser.add_argument('--transitions', type=int, default=100000, help='number of transitions per state-machine')
+    parser.add_argument('--trace', action='store_true', help='turn state-machine tracing on')
+    parser.add_argument('--json', action='store_true', help='output the report as json')
+    args = parser.parse_args()
+
+    logging.getLogger('ochopod').setLevel(logging.CRITICAL)
+    if args.trace:
+        trace.enable()
+
+    #
+    # - start all the actors and wait for them to be done
+    # - each latch is set with how long the actor took to go through its transitions
+    #
+    ts = time.time()
+    latches = [Latch() for _ in range(args.actors)]
+    for latch in latches:
+        Loop.start(latch, args.transitions)
+
+    lapses = wait_all(latches)
+    elapsed = time.time() - ts
+    report = \
+        {
+            'actors': args.actors,
+            'transitions': args.transitions,
+            'tracing': args.trace,
+            'elapsed (s)': round(elapsed, 3),
+            'per actor (transitions/s)': round(sum(args.transitions / lapse for lapse in lapses) / len(lapses), 1),
+            'aggregate (transitions/s)': round(args.actors * args.transitions / elapsed, 1)
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+
+    else:
+        print('%d actor(s) x %d transitions%s : %s transitions/s per actor, %s transitions/s overall (%s s)' %
+              (args.actors, args.transitions, ' (traced)' if args.trace else '', report['per actor (transitions/s)'],
+               report['aggregate (transitions/s)'], report['elapsed (s)']))
@@ -108,6 +108,10 @@ class Cluster(object):
     The important settings are "ip", "public" and "ports" (dict indexing ports the container exposes to their
     dynamically allocated counterpart). You may get additional settings depending on which bindings you use.
 
+    Each payload is a compact read-only :class:`ochopod.core.record.PodRecord` which you can use as a regular dict
+    (e.g pods[key]['ip']). Note that :func:`json.dumps` does not know about records and will raise a TypeError :
+    serialize them with :func:`ochopod.core.record.dumps` instead, or call their js() method to get an actual dict.
+
     The :attr:`seq` integer allows you to identify your pod within your cluster without any ambiguity. The
     :attr:`index` integer has to be used more carefully as any change in the cluster (e.g less pods for instance)
     will not be reflected accurately.
@@ -159,6 +163,45 @@ class Cluster(object):
         """
         pass
 
+    def by_seq(self, seq, dependency=None):
+        """
+        Ancillary helper to look a pod up by sequence counter. The lookup is done amongst the cluster pods unless
+        a dependency is specified.
+
+        :type seq: int
+        :type dependency: string
+        :param seq: sequence counter allocated to the pod
+        :param dependency: optional dependency cluster identifier to search instead
+        :rtype: the pod key or None if not found
+        """
+        pass
+
+    def by_node(self, node, dependency=None):
+        """
+        Ancillary helper returning the (ordered) keys of all the pods running on a given node. The lookup is done
+        amongst the cluster pods unless a dependency is specified.
+
+        :type node: string
+        :type dependency: string
+        :param node: resource id of the underlying node (e.g the EC2 instance identifier)
+        :param dependency: optional dependency cluster identifier to search instead
+        :rtype: list
+        """
+        pass
+
+    def by_ip(self, ip, dependency=None):
+        """
+        Ancillary helper returning the (ordered) keys of all the pods reachable via a given internal or public IP
+        address. The lookup is done amongst the cluster pods unless a dependency is specified.
+
+        :type ip: string
+        :type dependency: string
+        :param ip: IPv4 address
+        :param dependency: optional dependency cluster identifier to search instead
+        :rtype: list
+        """
+        pass
+
 
 class Tool(object):
     """
@@ -320,7 +363,8 @@ class LifeCycle(object):
 
         This method provides also a way to report arbitrary metrics. An optional dict may be returned to set the
         pod's metrics (which are accessible via a POST /info request). Please note those metrics will be returned as
-        serialized json.
+        serialized json. Any numeric value is also exposed as a gauge by GET /metrics (nested keys are joined with
+        underscores, e.g {'db': {'lag': 3}} becomes *ochopod_user_db_lag*).
 
         :type process: :class:`subprocess.Popen`
         :param process: the underlying process run by the pod
@@ -368,6 +412,12 @@ class Reactive(Model):
     #: impractical.
     damper = 0.0
 
+    #: Optional cap in seconds turning the damper into an adaptive one. If set (and larger than :attr:`damper`) the
+    #: countdown restarts whenever another change comes in, without ever going past *damper_max* seconds after the
+    #: first change. The :attr:`damper` then acts as a quiet window : bursts of changes (typically a rolling
+    #: deployment or a scale-up) are absorbed by one single configuration which fires as soon as things settle.
+    damper_max = 0.0
+
     #: Array listing what clusters we depend on (e.g 'zookeeper' for instance). We support both absolute and relative
     #: dependencies. If the identifier starts with '/' it is absolute otherwise it is assumed to be located within
     #: the same namespace. In addition wildcards may be used (e.g 'zoo*per' or 'service.database.*') to depend on
@@ -381,6 +431,13 @@ class Reactive(Model):
     #: with pods that are known to configure slowly.
     grace = 60.0
 
+    #: If true the leader will only configure the pods whose inputs changed since the last successful
+    #: configuration, e.g pods that just joined or all of them if any dependency changed. Every pod still gets the
+    #: pre-check (which is how dead pods are dropped) but the other ones are left running as-is and will not see the
+    #: configure or configured callbacks (which is fine for life-cycles that are not :attr:`Piped.strict`). This is
+    #: ignored when :attr:`full_shutdown` is set.
+    incremental = False
+
     #: If true the leader will fire its control requests to the pods one after the other. Otherwise all the
     #: pods will be sent requests in parallel.
     sequential = False
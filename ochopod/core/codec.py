@@ -0,0 +1,116 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import zlib
+
+from ochopod.core.record import dumps
+
+
+class Json(object):
+    """
+    Default codec, plain json. This is what every pod understands.
+    """
+
+    #: Codec name, as advertised by the pods.
+    name = 'json'
+
+    #: HTTP content type for the control requests.
+    content_type = 'application/json; charset=utf-8'
+
+    def encode(self, obj):
+
+        return dumps(obj)
+
+    def decode(self, value):
+
+        return json.loads(value)
+
+
+class Compact(Json):
+    """
+    Compact binary codec : json without whitespace and with sorted keys (e.g the same object always encodes to the
+    same value), deflated with zlib and prefixed with a versioned magic header (which json can't start with). The
+    keys and values repeated across pod payloads compress very well, which matters for large control payloads.
+    """
+
+    name = 'compact'
+
+    content_type = 'application/x-ochopod-compact'
+
+    #: Header prefixing any value encoded by this codec (the last byte is the format version).
+    magic = '\x00oc\x01'
+
+    def encode(self, obj):
+
+        return self.magic + zlib.compress(dumps(obj, separators=(',', ':'), sort_keys=True))
+
+    def decode(self, value):
+
+        #
+        # - raise a ValueError upon any invalid input, like json.loads() would
+        #
+        if not value.startswith(self.magic):
+            raise ValueError('unsupported compact header (newer pod ?)')
+
+        try:
+            return json.loads(zlib.decompress(value[len(self.magic):]))
+
+        except zlib.error as failure:
+            raise ValueError(str(failure))
+
+
+#: Codecs we support, indexed by name.
+CODECS = {codec.name: codec for codec in [Json(), Compact()]}
+
+#: Default codec.
+JSON = CODECS['json']
+
+
+def decode(value, content_type=None):
+    """
+    Decodes a value encoded with any of our codecs. The codec is picked using the content type if specified, and
+    by looking at the value header otherwise (anything that is not compact is assumed to be json, which is what
+    older pods write). A ValueError is raised if the value can't be decoded.
+
+    :type value: str
+    :param value: encoded value
+    :type content_type: str
+    :param content_type: optional HTTP content type
+    :rtype: anything
+    """
+
+    if content_type:
+        for codec in CODECS.values():
+            if content_type.split(';')[0].strip() == codec.content_type.split(';')[0]:
+                return codec.decode(value)
+
+    compact = CODECS['compact']
+    return compact.decode(value) if value.startswith(compact.magic[:3]) else JSON.decode(value)
+
+
+def negotiate(pod):
+    """
+    Returns the most compact codec supported by the specified pod, based on the codecs it advertises in its
+    registration payload. Older pods do not advertise anything and get json.
+
+    :type pod: dict
+    :param pod: pod registration payload (or :class:`ochopod.core.record.PodRecord`)
+    :rtype: codec
+    """
+
+    supported = pod.get('codecs') or []
+    return CODECS['compact'] if 'compact' in supported else JSON
@@ -21,13 +21,15 @@ import pykka
 import time
 import uuid
 
+from functools import partial
 from flask import Flask, request
-from kazoo.exceptions import ConnectionClosedError, NodeExistsError
+from kazoo.exceptions import ConnectionClosedError, KazooException, NodeExistsError
 from kazoo.client import KazooClient, KazooState
 from kazoo.recipe.lock import LockTimeout
-from ochopod.core.fsm import shutdown, spin_lock, Aborted, FSM
-from pykka import ThreadingFuture, Timeout
-from threading import Event
+from ochopod.core import metrics
+from ochopod.core.codec import CODECS
+from ochopod.core.fsm import shutdown, spin_lock, Aborted, FSM, Latch, Retry
+from ochopod.core.utils import Backoff
 
 
 #: Our ochopod logger
@@ -41,6 +43,21 @@ ROOT = '/ochopod/clusters'
 #: down depending on the actor
 SAMPLING = 1.0
 
+#: Longest time an idle state-machine will sleep for. Our state-machines otherwise wake up upon their next deadline
+#: or as soon as a relevant message (zookeeper event, request, etc.) comes in.
+IDLE = 30.0 * SAMPLING
+
+#: Factory used to allocate our zookeeper clients. This defaults to kazoo and can be overridden, for instance
+#: with :meth:`ochopod.core.emulator.Ensemble.client` to run against an in-memory zookeeper.
+FACTORY = KazooClient
+
+#: Backoff policy used to pace our zookeeper re-connection attempts (e.g upon a reset). The jitter spreads the
+#: re-connections of a large fleet of pods over time.
+RECONNECT = Backoff(base=SAMPLING, factor=2.0, cap=30.0 * SAMPLING, jitter=0.5)
+
+#: Runtime settings published by :class:`Publisher` (e.g what /info would return that is not already registered).
+STATUS = ['metrics', 'process', 'state', 'status']
+
 
 class ZK(FSM):
     """
@@ -58,33 +75,46 @@ class ZK(FSM):
         self.breadcrumbs = breadcrumbs
         self.connected = 0
         self.brokers = brokers
+        self.epoch = 0
         self.force_reset = 0
         self.hints = hints
         self.hints['state'] = 'follower'
         self.id = uuid.uuid4()
         self.prefix = '%s/%s.%s' % (ROOT, scope, tag)
+        self.resets = 0
         self.scope = scope
         self.seq = None
         self.tag = tag
 
-    def feedback(self, state):
+    def feedback(self, epoch, state):
 
         #
         # - forward the state change to the actor via a message
+        # - tag it with the client epoch to discard notifications from a client we already stopped
         # - the specialized() hook will process this safely
         #
         self.actor_ref.tell(
             {
                 'request': 'state change',
+                'epoch': epoch,
                 'state': state
             })
 
     def reset(self, data):
 
         self.connected = 0
+        self.epoch += 1
         self.force_reset = 0
         self.hints['state'] = 'follower'
         logger.warning('%s : actor reset (%s)' % (self.path, data.cause))
+        if hasattr(data, 'publisher'):
+
+            #
+            # - stop publishing our status (the ephemeral node will go away with the client)
+            #
+            shutdown(data.publisher)
+            delattr(data, 'publisher')
+
         if hasattr(data, 'zk'):
 
             #
@@ -97,7 +127,14 @@ class ZK(FSM):
         if self.terminate:
             super(ZK, self).reset(data)
 
-        return 'initial', data, 0
+        #
+        # - pause before re-connecting, backing off exponentially if we keep resetting
+        # - the counter is cleared once we managed to register
+        #
+        delay = RECONNECT.delay(self.resets)
+        self.resets += 1
+        logger.debug('%s : re-connecting in %2.1f seconds (reset #%d)' % (self.path, delay, self.resets))
+        return 'initial', data, delay
 
     def initial(self, data):
 
@@ -106,8 +143,8 @@ class ZK(FSM):
         #
         cnx_string = ','.join(self.brokers)
         logger.debug('%s : connecting @ %s' % (self.path, cnx_string))
-        data.zk = KazooClient(hosts=cnx_string, timeout=5.0, read_only=0, randomize_hosts=1)
-        data.zk.add_listener(self.feedback)
+        data.zk = metrics.instrument(FACTORY(hosts=cnx_string, timeout=5.0, read_only=0, randomize_hosts=1))
+        data.zk.add_listener(partial(self.feedback, self.epoch))
         data.zk.start()
         data.n = 0
 
@@ -120,22 +157,26 @@ class ZK(FSM):
 
         #
         # - loop back if we haven't received a CONNECTED event from the driver
+        # - the state change will wake us up
         #
         if not self.connected:
-            return 'wait_for_cnx', data, SAMPLING
+            return 'wait_for_cnx', data, IDLE
 
         #
         # - the /pods node holds all our ephemeral per-container data (one container == one child node)
+        # - the /status node holds the optional live status of each pod (using the same child node names)
         # - the /hash node stores the last recorded md5 hash (local pods + dependencies), which we use to
         #   flag any change amongst the pods or their dependencies
         #
         data.zk.ensure_path('%s/pods' % self.prefix)
         data.zk.ensure_path('%s/hash' % self.prefix)
+        data.zk.ensure_path('%s/status' % self.prefix)
         try:
 
             #
             # - register ourselves by creating an ephemeral
-            # - this is where we can store arbitrary information (e.g our breadcrumbs)
+            # - this is where we can store arbitrary information (e.g our breadcrumbs), encoded with whatever
+            #   codec $ochopod_codec specifies (json by default, which older pods can read)
             # - we ask for a sequence counter as well which we then keep (e.g in case of connection loss or reset
             #   we guarantee the pod won't get assigned a new index)
             # - this is *critical* for some use-cases (e.g Kafka where the broker index must remain the same)
@@ -145,8 +186,8 @@ class ZK(FSM):
             if self.seq is None:
                 self.seq = int(tokens[-1])
             self.breadcrumbs['seq'] = self.seq
-            js = json.dumps(self.breadcrumbs)
-            data.zk.set(path, js)
+            codec = CODECS[self.hints.get('codec', 'json')]
+            data.zk.set(path, codec.encode(self.breadcrumbs))
 
         except NodeExistsError:
 
@@ -159,7 +200,17 @@ class ZK(FSM):
             return 'wait_for_cnx', data, 5.0 * SAMPLING
 
         logger.debug('%s : registered as %s (#%d)' % (self.path, self.id, self.seq))
+        if self.hints.get('publish') == 'true':
+
+            #
+            # - start publishing our live status if requested
+            # - this ancillary actor piggy-backs on our zk client
+            #
+            status = '%s/status/%s' % (self.prefix, path.split('/')[-1])
+            data.publisher = Publisher.start(data.zk, status, self.hints)
+
         data.connected_at = time.time()
+        self.resets = 0
         return 'spin', data, 0
 
     def spin(self, data):
@@ -176,17 +227,24 @@ class ZK(FSM):
             # - we got a zk state change
             # - we only use the switch to CONNECTED to go from wait_for_cnx() to spin()
             # - ZK disconnects (LOST or SUSPENDED) are simply flagged when exceptions are raised
+            # - ignore anything coming from a client we already stopped (e.g kazoo reconnecting after a
+            #   session expiry)
             #
             state = msg['state']
             current = 'connected' if self.connected else 'disconnected'
             logger.debug('%s : zk state change -> "%s" (%s)' % (self.path, str(state), current))
-            if self.connected and state != KazooState.CONNECTED:
+            if msg['epoch'] != self.epoch:
+                pass
+
+            elif self.connected and state != KazooState.CONNECTED:
                 logger.warning('%s : lost connection (%s) / forcing a reset' % (self.path, str(state)))
                 self.force_reset = 1
                 self.connected = 0
+                self.wake()
 
             elif state == KazooState.CONNECTED:
                 self.connected = 1
+                self.wake()
 
         elif req == 'reset':
 
@@ -195,6 +253,7 @@ class ZK(FSM):
             # - this is typically invoked from the CLI
             #
             self.force_reset = 1
+            self.wake()
 
         else:
             super(ZK, self).specialized(msg)
@@ -277,7 +336,8 @@ class Coordinator(ZK):
         # - we have the lock (e.g we are the leader)
         # - start the controller actor
         #
-        data.latch = ThreadingFuture()
+        data.latch = Latch()
+        data.latch.listen(partial(self.released, self.epoch))
         logger.debug('%s : lock acquired @ %s, now leading' % (self.path, self.prefix))
         data.controller = self.model.start(data.zk, self.id, self.hints, self.scope, self.tag, self.port, data.latch)
 
@@ -292,16 +352,178 @@ class Coordinator(ZK):
             raise Aborted('resetting')
 
         #
-        # - spin-lock on the controller latch
+        # - check the controller latch
         # - any catastrophic plug failure will be trapped that way
+        # - sleep otherwise (we'll be woken up as soon as the latch is set)
         #
-        try:
-            Event()
-            out = data.latch.get(SAMPLING)
+        if data.latch.done:
+            out = data.latch.outcome()
             if isinstance(out, Exception):
                 raise out
 
-        except Timeout:
+        return 'lock', data, IDLE
+
+    def released(self, epoch, latch):
+
+        #
+        # - latch listener invoked when the controller goes down
+        # - forward to the actor via a message (tagged with the client epoch like zk state changes)
+        # - this is run by the controller thread : silently trap any failure (e.g we are already dead)
+        #
+        try:
+            self.actor_ref.tell(
+                {
+                    'request': 'controller down',
+                    'epoch': epoch
+                })
+
+        except Exception:
             pass
 
-        return 'lock', data, 0
\ No newline at end of file
+    def specialized(self, msg):
+
+        assert 'request' in msg, 'bogus message received ?'
+        req = msg['request']
+        if req == 'controller down':
+
+            #
+            # - the controller latch is set, wake up to check on it
+            # - ignore it if we already reset (we would otherwise cut our re-connection pause short)
+            #
+            if msg['epoch'] == self.epoch:
+                self.wake()
+
+        else:
+            super(Coordinator, self).specialized(msg)
+
+
+class Publisher(FSM):
+    """
+    Ancillary actor publishing the live status of the pod (e.g its process, state, status and metrics) to an
+    ephemeral zookeeper node. This allows 3rd parties to read the whole cluster status in one sweep instead of hitting
+    each pod over HTTP.
+
+    The node is written only when the status actually changes and at most once every *every* seconds (changes
+    happening in the meantime are batched). It lives outside of /pods, meaning it does not impact the pod snapshots
+    nor the cluster hash (e.g publishing never triggers a re-configuration).
+
+    Zookeeper failures are re-tried forever using *backoff* (we don't want to lose the publisher over a transient
+    glitch, a lost session will reset the coordinator which then restarts us anyway).
+    """
+
+    #: Re-try policy upon zookeeper failures (capped to *every* since a pause can't be cut short by a shutdown).
+    backoff = Backoff(base=SAMPLING, factor=2.0, cap=5.0 * SAMPLING, jitter=0.5)
+
+    #: Minimum delay in seconds between two writes.
+    every = 5.0 * SAMPLING
+
+    def __init__(self, zk, node, hints):
+        super(Publisher, self).__init__()
+
+        self.dirty = 1
+        self.hints = hints
+        self.node = node
+        self.path = 'publisher'
+        self.zk = zk
+
+    def reset(self, data):
+
+        self.hints.unsubscribe(self.changed)
+        return super(Publisher, self).reset(data)
+
+    def initial(self, data):
+
+        #
+        # - if the termination trigger is set (e.g while re-trying), abort immediately
+        #
+        if self.terminate:
+            self.exitcode()
+
+        #
+        # - create our ephemeral node right away
+        # - the node may already exist if a previous attempt went through without us getting the reply
+        # - subscribe to the hints to be notified of any change
+        #
+        data.last = None
+        data.next = 0
+        try:
+            self.zk.create(self.node, value='{}', ephemeral=True)
+
+        except NodeExistsError:
+            pass
+
+        except KazooException as failure:
+            raise Retry('unable to create %s (%s)' % (self.node, failure), backoff=self.backoff)
+
+        self.hints.subscribe(self.changed)
+        return 'spin', data, 0
+
+    def spin(self, data):
+
+        #
+        # - if the termination trigger is set, abort immediately
+        #
+        if self.terminate:
+            self.hints.unsubscribe(self.changed)
+            self.exitcode()
+
+        #
+        # - if we published less than *every* seconds ago wait a bit (any change coming in the meantime is batched)
+        # - otherwise read our status and write it if it differs from what we published last
+        #
+        now = time.time()
+        if self.dirty:
+            if now < data.next:
+                return 'spin', data, data.next - now
+
+            self.dirty = 0
+            _, js = self.hints.snapshot(STATUS)
+            if js != data.last:
+                try:
+                    self.zk.set(self.node, json.dumps(js))
+
+                except KazooException as failure:
+
+                    #
+                    # - stay dirty so that the next attempt publishes again
+                    #
+                    self.dirty = 1
+                    raise Retry('unable to write %s (%s)' % (self.node, failure), backoff=self.backoff)
+
+                logger.debug('%s : status published (%s)' % (self.path, js.get('process', '?')))
+                data.last = js
+                data.next = now + self.every
+
+        return 'spin', data, IDLE
+
+    def changed(self, version, keys):
+
+        #
+        # - hints subscriber, run by whatever thread changed them
+        # - forward to the actor if any of the keys we publish changed
+        # - silently trap any failure (e.g we are already dead)
+        #
+        if any(key in STATUS for key in keys):
+            try:
+                self.actor_ref.tell(
+                    {
+                        'request': 'status changed'
+                    })
+
+            except Exception:
+                pass
+
+    def specialized(self, msg):
+
+        assert 'request' in msg, 'bogus message received ?'
+        req = msg['request']
+        if req == 'status changed':
+
+            #
+            # - flag the change and wake up (we'll go back to sleep if we are still rate-limited)
+            #
+            self.dirty = 1
+            self.wake()
+
+        else:
+            super(Publisher, self).specialized(msg)
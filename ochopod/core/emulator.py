@@ -0,0 +1,472 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import heapq
+import logging
+import time
+import uuid
+
+from contextlib import contextmanager
+from kazoo.client import KazooState
+from kazoo.exceptions import LockTimeout, NoNodeError, NodeExistsError, NotEmptyError, SessionExpiredError
+from kazoo.protocol.states import EventType, KeeperState, WatchedEvent, ZnodeStat
+from Queue import Queue
+from threading import Condition, Lock, RLock, Thread
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+
+class _Node(object):
+    """
+    One znode : its value, versions and children names. Ephemeral nodes also keep track of their session.
+    """
+
+    __slots__ = ('children', 'ctime', 'cversion', 'mtime', 'owner', 'value', 'version')
+
+    def __init__(self, value, owner):
+
+        self.children = set()
+        self.ctime = self.mtime = int(time.time() * 1000)
+        self.cversion = 0
+        self.owner = owner
+        self.value = value
+        self.version = 0
+
+
+class Ensemble(object):
+    """
+    In-memory zookeeper stand-in, shared by any number of emulated clients within the same process. It implements
+    the subset of the zookeeper semantics ochopod relies on (ephemeral & sequential nodes, one-shot data & child
+    watches, session life-cycle) and is meant to simulate clusters on a single machine, e.g for benchmarking.
+
+    Plug it in by overriding the client factory used by :class:`ochopod.core.core.ZK`::
+
+        ensemble = Ensemble(latency=0.002)
+        ochopod.core.core.FACTORY = ensemble.client
+
+    Watch notifications and state changes are delivered in order by a single dispatcher thread, like kazoo does.
+    Each operation is counted and can be delayed to emulate a remote ensemble.
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        :type latency: float
+        :param latency: delay in seconds added to each operation
+        """
+
+        self.clients = {}
+        self.deadlines = []
+        self.events = Queue()
+        self.latency = latency
+        self.lock = RLock()
+        self.nodes = {'/': _Node('', 0)}
+        self.ops = {}
+        self.sessions = 0
+        self.since = time.time()
+        self.waiters = {}
+        self.watches = {'child': {}, 'data': {}}
+
+        for target in [self._dispatch, self._tick]:
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def client(self, hosts=None, **kwargs):
+        """
+        Returns a new emulated client, accepting the same arguments as :class:`kazoo.client.KazooClient` (which
+        are ignored).
+
+        :rtype: :class:`Client`
+        """
+
+        return Client(self)
+
+    def expire(self, client):
+        """
+        Injects a session expiry : the ephemeral nodes and watches of the client are dropped and its listeners are
+        notified (LOST). The client then automatically gets a new session (CONNECTED), which is what kazoo does.
+
+        :type client: :class:`Client`
+        :param client: client whose session should expire
+        """
+
+        with self.lock:
+            if not client.session:
+                return
+
+            self._close(client)
+            self._open(client)
+
+    def stats(self):
+        """
+        Returns the number of nodes, sessions and operations (total and per second) so far.
+
+        :rtype: dict
+        """
+
+        with self.lock:
+            total = sum(self.ops.values())
+            return \
+                {
+                    'nodes': len(self.nodes),
+                    'sessions': len(self.clients),
+                    'ops': dict(self.ops),
+                    'ops/s': round(total / max(time.time() - self.since, 1e-3), 1)
+                }
+
+    def _close(self, client):
+
+        #
+        # - drop the ephemeral nodes and watches owned by the session
+        # - notify the client listeners
+        #
+        session = client.session
+        client.session = 0
+        del self.clients[session]
+        for path in sorted([path for path, node in self.nodes.items() if node.owner == session], reverse=True):
+            self._delete(path)
+
+        for watches in self.watches.values():
+            for path, callbacks in watches.items():
+                callbacks -= set((owner, callback) for owner, callback in callbacks if owner == session)
+
+        self._notify(client, KazooState.LOST)
+
+    def _count(self, op):
+
+        #
+        # - emulate the round-trip to the ensemble (outside of the lock)
+        #
+        with self.lock:
+            self.ops[op] = self.ops.get(op, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _delete(self, path):
+
+        parent, name = path.rsplit('/', 1)
+        parent = parent or '/'
+        del self.nodes[path]
+        self.nodes[parent].children.discard(name)
+        self.nodes[parent].cversion += 1
+        self._trigger('data', path, EventType.DELETED)
+        self._trigger('child', path, EventType.DELETED)
+        self._trigger('child', parent, EventType.CHILD)
+
+        #
+        # - wake up whoever waits on this node to go away (e.g the next lock contender)
+        #
+        for waiter in self.waiters.pop(path, ()):
+            waiter.notify()
+
+    def _dispatch(self):
+
+        #
+        # - deliver the watch notifications & state changes one at a time, in order
+        # - silently trap any failure in the callbacks
+        #
+        while True:
+            callback, arg = self.events.get()
+            try:
+                callback(arg)
+
+            except Exception as failure:
+                logger.debug('emulator : callback failed (%s)' % failure)
+
+    def _notify(self, client, state):
+
+        for listener in client.listeners:
+            self.events.put((listener, state))
+
+    def _open(self, client):
+
+        self.sessions += 1
+        client.session = self.sessions
+        self.clients[client.session] = client
+        self._notify(client, KazooState.CONNECTED)
+
+    def _sleep(self, waiter, deadline):
+
+        #
+        # - block on the condition until notified or until the deadline (if any) is reached
+        # - python 2 timed waits are polling : rely on our ticker thread instead of using a timeout
+        # - the lock must be held
+        #
+        if deadline is not None:
+            heapq.heappush(self.deadlines, (deadline, id(waiter), waiter))
+
+        waiter.wait()
+
+    def _tick(self):
+
+        #
+        # - wake up whoever waits past its deadline
+        #
+        while True:
+            time.sleep(0.01)
+            with self.lock:
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    _, _, waiter = heapq.heappop(self.deadlines)
+                    waiter.notify()
+
+    def _trigger(self, kind, path, event):
+
+        #
+        # - zookeeper watches are one-shot : remove them as we fire them
+        #
+        callbacks = self.watches[kind].pop(path, ())
+        for _, callback in callbacks:
+            self.events.put((callback, WatchedEvent(event, KeeperState.CONNECTED, path)))
+
+    def _watch(self, client, kind, path, callback):
+
+        if callback:
+            self.watches[kind].setdefault(path, set()).add((client.session, callback))
+
+
+class Client(object):
+    """
+    Emulated kazoo client, bound to a :class:`Ensemble`. It supports the subset of the
+    :class:`kazoo.client.KazooClient` API used by ochopod and raises the same exceptions.
+    """
+
+    def __init__(self, ensemble):
+
+        self.ensemble = ensemble
+        self.listeners = []
+        self.session = 0
+
+    def add_listener(self, listener):
+
+        self.listeners.append(listener)
+
+    def start(self, timeout=15):
+
+        with self.ensemble.lock:
+            if not self.session:
+                self.ensemble._open(self)
+
+    def stop(self):
+
+        with self.ensemble.lock:
+            if self.session:
+                self.ensemble._close(self)
+
+    def close(self):
+        pass
+
+    def ensure_path(self, path, acl=None):
+
+        with self._session('ensure_path'):
+            tokens = path.strip('/').split('/')
+            for n in range(len(tokens)):
+                partial = '/' + '/'.join(tokens[:n + 1])
+                if partial not in self.ensemble.nodes:
+                    self._create(partial, '', None)
+
+        return True
+
+    def create(self, path, value='', acl=None, ephemeral=False, sequence=False, makepath=False):
+
+        with self._session('create'):
+            parent = path.rsplit('/', 1)[0] or '/'
+            if parent not in self.ensemble.nodes:
+                if not makepath:
+                    raise NoNodeError()
+                self.ensure_path(parent)
+
+            if sequence:
+                path = '%s%010d' % (path, self.ensemble.nodes[parent].cversion)
+
+            if path in self.ensemble.nodes:
+                raise NodeExistsError()
+
+            self._create(path, value, self.session if ephemeral else None)
+            return path
+
+    def delete(self, path, version=-1, recursive=False):
+
+        with self._session('delete'):
+            node = self._node(path)
+            if node.children and not recursive:
+                raise NotEmptyError()
+
+            for child in sorted([child for child in self.ensemble.nodes if child.startswith(path + '/')],
+                                reverse=True):
+                self.ensemble._delete(child)
+
+            self.ensemble._delete(path)
+            return True
+
+    def exists(self, path, watch=None):
+
+        with self._session('exists'):
+            self.ensemble._watch(self, 'data', path, watch)
+            node = self.ensemble.nodes.get(path)
+            return self._stat(node) if node else None
+
+    def get(self, path, watch=None):
+
+        with self._session('get'):
+            node = self._node(path)
+            self.ensemble._watch(self, 'data', path, watch)
+            return node.value, self._stat(node)
+
+    def get_children(self, path, watch=None, include_data=False):
+
+        with self._session('get_children'):
+            node = self._node(path)
+            self.ensemble._watch(self, 'child', path, watch)
+            children = list(node.children)
+            return (children, self._stat(node)) if include_data else children
+
+    def set(self, path, value, version=-1):
+
+        with self._session('set'):
+            node = self._node(path)
+            node.value = value
+            node.version += 1
+            node.mtime = int(time.time() * 1000)
+            self.ensemble._trigger('data', path, EventType.CHANGED)
+            return self._stat(node)
+
+    def Lock(self, path, identifier=''):
+
+        return _Lock(self, path)
+
+    @contextmanager
+    def _session(self, op):
+
+        #
+        # - count the operation and emulate the round-trip to the ensemble
+        # - then run it atomically, provided our session is still alive
+        #
+        self.ensemble._count(op)
+        with self.ensemble.lock:
+            if not self.session:
+                raise SessionExpiredError()
+
+            yield
+
+    def _create(self, path, value, owner):
+
+        parent, name = path.rsplit('/', 1)
+        parent = parent or '/'
+        self.ensemble.nodes[path] = _Node(value, owner)
+        self.ensemble.nodes[parent].children.add(name)
+        self.ensemble.nodes[parent].cversion += 1
+        self.ensemble._trigger('data', path, EventType.CREATED)
+        self.ensemble._trigger('child', parent, EventType.CHILD)
+
+    def _node(self, path):
+
+        node = self.ensemble.nodes.get(path)
+        if node is None:
+            raise NoNodeError()
+
+        return node
+
+    def _stat(self, node):
+
+        return ZnodeStat(0, 0, node.ctime, node.mtime, node.version, node.cversion, 0, node.owner or 0,
+                         len(node.value), len(node.children), 0)
+
+
+class _Lock(object):
+    """
+    Emulated kazoo lock recipe (a queue of ephemeral sequential contender nodes, the lowest one holding the lock).
+    Each contender only waits on its predecessor to go away, which avoids waking everybody up upon each release.
+    """
+
+    def __init__(self, client, path):
+
+        self.client = client
+        self.is_acquired = False
+        self.node = None
+        self.path = path
+        self.lock = Lock()
+
+    def acquire(self, blocking=True, timeout=None):
+
+        ensemble = self.client.ensemble
+        with self.lock:
+            if self.is_acquired:
+                return True
+
+            #
+            # - queue up behind the other contenders
+            # - wait until we hold the lowest sequence number (or until we timeout)
+            #
+            self.client.ensure_path(self.path)
+            self.node = self.client.create('%s/%s__lock__' % (self.path, uuid.uuid4().hex), ephemeral=True,
+                                           sequence=True)
+
+            deadline = None if timeout is None else time.time() + timeout
+            with ensemble.lock:
+                while 1:
+                    node = ensemble.nodes.get(self.node)
+                    if node is None or node.owner != self.client.session:
+                        self.node = None
+                        raise SessionExpiredError()
+
+                    contenders = sorted(ensemble.nodes[self.path].children, key=lambda child: child[-10:])
+                    index = contenders.index(self.node[len(self.path) + 1:])
+                    if not index:
+                        self.is_acquired = True
+                        return True
+
+                    left = None if deadline is None else deadline - time.time()
+                    if not blocking or (left is not None and left <= 0):
+                        ensemble._delete(self.node)
+                        self.node = None
+                        if not blocking:
+                            return False
+                        raise LockTimeout('failed to acquire lock on %s after %s seconds' % (self.path, timeout))
+
+                    #
+                    # - wait for our predecessor to go away (or for our own node to vanish, e.g session expiry)
+                    #
+                    waiter = Condition(ensemble.lock)
+                    paths = ['%s/%s' % (self.path, contenders[index - 1]), self.node]
+                    for path in paths:
+                        ensemble.waiters.setdefault(path, []).append(waiter)
+
+                    ensemble._sleep(waiter, deadline)
+                    for path in paths:
+                        waiters = ensemble.waiters.get(path, [])
+                        if waiter in waiters:
+                            waiters.remove(waiter)
+                        if not waiters:
+                            ensemble.waiters.pop(path, None)
+
+    def release(self):
+
+        with self.lock:
+            if not self.is_acquired:
+                return False
+
+            try:
+                self.client.delete(self.node)
+
+            except (NoNodeError, SessionExpiredError):
+                pass
+
+            self.is_acquired = False
+            self.node = None
+            return True
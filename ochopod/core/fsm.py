@@ -14,37 +14,66 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import copy
+import errno
+import fcntl
+import heapq
+import itertools
 import logging
+import os
+import select
 import sys
 import time
 import traceback
 
+from collections import deque
+from ochopod.core import trace
 from pykka import ThreadingActor, ThreadingFuture, Timeout
 from pykka.exceptions import ActorDeadError
-from threading import Event, Thread
+from Queue import Queue
+from threading import current_thread, Condition, Lock, Thread, _MainThread
 
 #: our pycse logger
 logger = logging.getLogger('ochopod')
 
+#: Shared timer posting the delayed messages of all our state-machines, None to use one thread per delayed message.
+TIMER = None
+
+
+def share_timer():
+    """
+    Switches to one single timer thread posting the delayed messages of all our state-machines (this is a process-wide
+    setting that must be applied before starting any actor). By default each delayed message is posted by its own
+    ancillary thread, which is simple but costs one thread per pending transition. Calling it more than once is
+    harmless.
+
+    :rtype: :class:`_Timer`
+    """
+    global TIMER
+    if TIMER is None:
+        TIMER = _Timer()
+        TIMER.start()
+
+    return TIMER
+
 
 def spin_lock(latch, strict=1, spin=0.5):
     """
-    Simple "spin lock" where we wait on a future with a small timeout and loop back until something is
-    set.
+    Simple "spin lock" where we wait on a future until something is set. Worker threads block without any
+    timeout (e.g they wake up exactly when the future is set). The main thread waits in slices of *spin* seconds
+    instead, otherwise it could not be interrupted (e.g by a CTRL-C).
 
     :type latch: :class:`pykka.ThreadingFuture`
     :param latch: future to block on
     :type strict: bool
     :param strict: if true the method will raise if ever the future outcome is an exception
     :type spin: float
-    :param spin: wait timeout in seconds
+    :param spin: wait timeout in seconds when invoked from the main thread
     :rtype: the future outcome
     """
+    timeout = spin if isinstance(current_thread(), _MainThread) else None
     while 1:
         try:
-            Event()
-            out = latch.get(timeout=spin)
+            out = latch.get(timeout=timeout)
             if strict and isinstance(out, Exception):
                 raise out
 
@@ -53,22 +82,52 @@ def spin_lock(latch, strict=1, spin=0.5):
             pass
 
 
+def wait_all(latches, strict=1, spin=0.5):
+    """
+    Blocks until all the specified latches are set and returns their outcomes (in the same order). If strict
+    the method will raise as soon as *any* outcome is an exception, without waiting for the other latches.
+
+    :type latches: list
+    :param latches: one or more :class:`Latch`
+    :type strict: bool
+    :param strict: if true the method will raise upon the first future outcome that is an exception
+    :type spin: float
+    :param spin: wait timeout in seconds when invoked from the main thread
+    :rtype: list
+    """
+    _wait(latches, len(latches), strict, spin)
+    return [latch.outcome() for latch in latches]
+
+
+def wait_any(latches, spin=0.5):
+    """
+    Blocks until at least one of the specified latches is set and returns it.
+
+    :type latches: list
+    :param latches: one or more :class:`Latch`
+    :type spin: float
+    :param spin: wait timeout in seconds when invoked from the main thread
+    :rtype: :class:`Latch`
+    """
+    return _wait(latches, 1, 0, spin)[0]
+
+
 def block(creator, strict=1, spin=0.5, collect=None):
     """
-    Compound spin-lock creating a latch, passing it to a lambda and then blocking.
+    Compound lock creating a latch, passing it to a lambda and then blocking.
 
     :type creator: lambda
-    :param creator: lambda taking a :class:`pykka.ThreadingFuture` as parameter
+    :param creator: lambda taking a :class:`Latch` as parameter
     :type strict: bool
     :param strict: if true the method will raise if ever the future outcome is an exception
     :type spin: float
-    :param spin: wait timeout in seconds
+    :param spin: wait timeout in seconds when invoked from the main thread
     :type collect: list
     :param collect: receives the lambda result if specified
     :rtype:
     """
 
-    latch = ThreadingFuture()
+    latch = Latch()
     ref = creator(latch)
     if collect is not None:
         collect.append(ref)
@@ -78,45 +137,28 @@ def block(creator, strict=1, spin=0.5, collect=None):
 
 def block_n(creators, strict=1, spin=0.5, collect=None):
     """
-    Compound spin-lock creating a set of latches latch, passing them to lambdas and then blocking on all
-    of them.
+    Compound lock creating a set of latches, passing them to lambdas and then blocking on all of them. The
+    outcomes are returned in the same order as the lambdas.
 
     :type creators: list
-    :param creators: one or more lambdas returning a :class:`pykka.ThreadingFuture`
+    :param creators: one or more lambdas taking a :class:`Latch` as parameter
     :type strict: bool
-    :param strict: if true the method will raise if ever *any* future outcome is an exception
+    :param strict: if true the method will raise as soon as *any* future outcome is an exception
     :type spin: float
-    :param spin: wait timeout in seconds
+    :param spin: wait timeout in seconds when invoked from the main thread
     :type collect: list
     :param collect: receives the lambda results if specified
-    :rtype:
+    :rtype: list
     """
 
     def _start():
-        latch = ThreadingFuture()
+        latch = Latch()
         ref = creator(latch)
         if collect is not None:
             collect.append(ref)
         return latch
 
-    out = []
-    latches = [_start() for creator in creators]
-    top = latches.pop()
-    while 1:
-        try:
-            Event()
-            out.append(top.get(timeout=spin))
-            if not len(latches):
-                break
-            top = latches.pop()
-        except Timeout:
-            pass
-
-    for item in out:
-        if strict and isinstance(item, Exception):
-            raise item
-
-    return out
+    return wait_all([_start() for creator in creators], strict, spin)
 
 
 def shutdown(actor_ref, timeout=None):
@@ -134,7 +176,6 @@ def shutdown(actor_ref, timeout=None):
 
         latch = ThreadingFuture()
         actor_ref.tell({'request': 'shutdown', 'latch': latch})
-        Event()
         latch.get(timeout=timeout)
 
     except Timeout:
@@ -160,14 +201,115 @@ def diagnostic(failure):
     return '%s (%d) -> %s%s' % (where, line, type(failure).__name__, why)
 
 
+class Latch(ThreadingFuture):
+    """
+    Future notifying listeners once it is set. This is what we use to wait on several futures at once, using one
+    condition variable, without having to spin.
+    """
+
+    def __init__(self):
+        super(Latch, self).__init__()
+
+        self.done = 0
+        self.listeners = []
+        self.lock = Lock()
+
+    def set(self, value=None):
+
+        super(Latch, self).set(value)
+        self._notify()
+
+    def set_exception(self, exc_info=None):
+
+        super(Latch, self).set_exception(exc_info)
+        self._notify()
+
+    def listen(self, callback):
+        """
+        Registers a callback invoked with the latch once it is set (right away if it already is). The callback is
+        run by whatever thread sets the latch and must therefore be quick.
+
+        :type callback: callable
+        :param callback: invoked with the latch as parameter
+        """
+
+        with self.lock:
+            if not self.done:
+                self.listeners.append(callback)
+                return
+
+        callback(self)
+
+    def outcome(self):
+        """
+        Returns the outcome of a latch that is set, or the exception it was set with.
+
+        :rtype: the future outcome
+        """
+
+        try:
+            return self.get(timeout=0)
+
+        except Exception as failure:
+            return failure
+
+    def _notify(self):
+
+        with self.lock:
+            self.done = 1
+            listeners, self.listeners = self.listeners, []
+
+        for callback in listeners:
+            callback(self)
+
+
+def _wait(latches, count, strict, spin):
+
+    #
+    # - listen to all the latches using one single condition variable
+    # - each latch will append itself to the list upon being set
+    # - wait until we have enough of them or until one failed if strict is set
+    # - the main thread must use a timeout to remain interruptible
+    #
+    done = []
+    cnd = Condition()
+    timeout = spin if isinstance(current_thread(), _MainThread) else None
+
+    def _set(latch):
+        with cnd:
+            done.append(latch)
+            cnd.notify()
+
+    for latch in latches:
+        latch.listen(_set)
+
+    with cnd:
+        checked = 0
+        while 1:
+            if strict:
+                for latch in done[checked:]:
+                    out = latch.outcome()
+                    if isinstance(out, Exception):
+                        raise out
+                checked = len(done)
+
+            if len(done) >= count:
+                return list(done)
+
+            cnd.wait(timeout)
+
+
 class Retry(Exception):
     """
-    Exception thrown to trip the machine back to the same state after an optional pause.
+    Exception thrown to trip the machine back to the same state after an optional pause. If a backoff policy
+    (e.g :class:`ochopod.core.utils.Backoff`) is specified it will define the pause instead and the machine will
+    be reset once its maximum elapsed time is exceeded.
     """
 
-    def __init__(self, why='N/A', delay=0):
+    def __init__(self, why='N/A', delay=0, backoff=None):
         self.why = why
         self.delay = delay
+        self.backoff = backoff
 
 
 class PoisonPill(Exception):
@@ -195,6 +337,9 @@ class FSM(ThreadingActor):
     a method.
     """
 
+    #: Mailbox depth above which we log a warning (0 to disable).
+    high_water = 64
+
     def __init__(self, payload=None):
 
         super(FSM, self).__init__()
@@ -202,7 +347,9 @@ class FSM(ThreadingActor):
         self.dying = 0
         self.latches = []
         self.path = '?'
-        self.payload = _Container(copy.deepcopy(payload) if payload else {})
+        self.payload = _Container(payload if payload else {})
+        self.scheduled = None
+        self.states = {}
         self.terminate = 0
 
     def exitcode(self, code=None):
@@ -212,7 +359,6 @@ class FSM(ThreadingActor):
         #
         while len(self.latches) > 0:
             self.latches.pop().set(code)
-            Event()
 
         #
         # - we're done, commit suicide
@@ -228,6 +374,11 @@ class FSM(ThreadingActor):
         logger.debug('%s : reset (%s)' % (self.path, data.cause))
         self.exitcode(data.cause if isinstance(data.cause, Aborted) else Aborted(data.diagnostic))
 
+    @staticmethod
+    def _create_actor_inbox():
+
+        return _Inbox()
+
     def initial(self, data):
 
         raise NotImplementedError
@@ -259,24 +410,70 @@ class FSM(ThreadingActor):
                 else:
                     self.latches.append(msg['latch'])
 
-    def fire(self, payload, delay=0):
+            #
+            # - don't wait for the next transition to act on the termination trigger
+            #
+            self.wake()
+
+    def fire(self, payload, delay=0, interruptible=1):
 
         if delay > 0:
             #
-            # - run an ancillary thread that will sleep and then fire the message
+            # - hand the message over to the shared timer or run an ancillary thread that will sleep and then fire it
             # - the machine itself won't block and will be able to process incoming messages
+            # - keep track of it unless it must not be expedited by wake()
             #
             scheduled = _Scheduled(self.actor_ref, payload, delay)
-            scheduled.start()
+            self.scheduled = scheduled if interruptible else None
+            if TIMER:
+                TIMER.schedule(scheduled)
+            else:
+                thread = Thread(target=scheduled.run)
+                thread.daemon = True
+                thread.start()
 
         else:
             #
             # - fire right now
             #
+            self.scheduled = None
             self.actor_ref.tell(payload)
 
+    def wake(self):
+        """
+        Fires the pending state transition right away instead of waiting for its delay to elapse. This allows
+        states to sleep until their next deadline and still react as soon as a relevant message comes in. This is
+        a no-op if there is no pending transition.
+        """
+
+        scheduled, self.scheduled = self.scheduled, None
+        if scheduled and scheduled.claim():
+            self.actor_ref.tell(scheduled.msg)
+
+    def _lookup(self, state):
+
+        #
+        # - resolve the state method once and cache it (bound) to avoid a getattr() upon each transition
+        #
+        func = getattr(self, state, None)
+        assert func, '<' + state + '> does not exist'
+        assert callable(func), '<' + state + '> must be a callable'
+        self.states[state] = func
+        return func
+
+    def on_stop(self):
+
+        trace.unregister(self.path, self.actor_inbox)
+
     def on_start(self):
 
+        #
+        # - register our mailbox to report its statistics
+        #
+        self.actor_inbox.path = self.path
+        self.actor_inbox.high_water = self.high_water
+        trace.register(self.path, self.actor_inbox)
+
         #
         # - trip the machine into its initial state
         #
@@ -301,6 +498,9 @@ class FSM(ThreadingActor):
 
         else:
             cmd = msg['fsm']
+            state = cmd['state']
+            tracer = trace.TRACER
+            started = time.time() if tracer else 0
             try:
                 if self.dying:
                     #
@@ -308,21 +508,25 @@ class FSM(ThreadingActor):
                     #
                     pass
                 else:
-                    func = getattr(self, cmd['state'], None)
-                    assert func, '<' + cmd['state'] + '> does not exist'
-                    assert callable(func), '<' + cmd['state'] + '> must be a callable'
+                    func = self.states.get(state)
+                    if func is None:
+                        func = self._lookup(state)
+
                     next, data, delay = func(cmd['data'])
-                    data['previous'] = cmd['state']
-                    payload = \
-                        {
-                            'fsm':
-                                {
-                                    'state': next,
-                                    'data': data
-                                }
-                        }
+                    data['previous'] = state
                     assert delay >= 0, 'the delay until the next state switch must be positive'
-                    self.fire(payload, delay)
+
+                    #
+                    # - there is only ever one transition message in flight per machine and we just picked it
+                    # - re-use it for the next transition instead of allocating a new one
+                    # - drop any retry accounting since we are moving on
+                    #
+                    if 'retries' in cmd:
+                        cmd.clear()
+
+                    cmd['state'] = next
+                    cmd['data'] = data
+                    self.fire(msg, delay)
 
             except PoisonPill:
 
@@ -331,28 +535,50 @@ class FSM(ThreadingActor):
 
             except Retry as failure:
 
-                assert cmd['state'] != 'reset', 'retrying is not allowed from the reset state'
-                delay = failure.delay
+                assert state != 'reset', 'retrying is not allowed from the reset state'
                 now = time.time()
-
+                attempt = cmd.get('retries', 0)
                 if 'retried at' not in cmd:
 
                     #
                     # - 1st attempt to retry : set the timestamp
-                    # - loop back to the same state
                     #
                     cmd['retried at'] = now
-                    self.fire(msg, delay)
+
+                backoff = failure.backoff
+                if backoff and backoff.expired(now - cmd['retried at']):
+
+                    #
+                    # - we've been retrying for too long, give up and reset
+                    #
+                    if tracer:
+                        tracer.failed(self.path, state)
+
+                    data = cmd['data']
+                    data.cause = Aborted('%s : gave up after %d retries (%s)' % (state, attempt, failure.why))
+                    data.previous = state
+                    data.diagnostic = str(data.cause)
+                    self.actor_ref.tell({'fsm': {'state': 'reset', 'data': data}})
 
                 else:
 
-                    self.fire(msg, delay)
+                    #
+                    # - loop back to the same state, pausing as specified by the backoff policy if any
+                    #
+                    cmd['retries'] = attempt + 1
+                    if tracer:
+                        tracer.retried(self.path, state, attempt + 1)
+
+                    self.fire(msg, backoff.delay(attempt) if backoff else failure.delay, interruptible=0)
 
             except Aborted as failure:
 
+                if tracer:
+                    tracer.failed(self.path, state)
+
                 data = cmd['data']
                 data.cause = failure
-                data.previous = cmd['state']
+                data.previous = state
                 data.diagnostic = str(failure)
                 self.actor_ref.tell({'fsm': {'state': 'reset', 'data': data}})
 
@@ -362,7 +588,7 @@ class FSM(ThreadingActor):
                 # - if an assert blew up or if we got interrupted, get the file/line information and reset
                 # - if this happened in the 'reset' state, kill the actor
                 #
-                if cmd['state'] == 'reset':
+                if state == 'reset':
 
                     logger.debug('%s : exception trapped while resetting (%s)' % (self.path, str(failure)))
                     _kill(self.actor_ref)
@@ -370,28 +596,60 @@ class FSM(ThreadingActor):
 
                 else:
 
+                    if tracer:
+                        tracer.failed(self.path, state)
+
                     data = cmd['data']
                     data.cause = failure
-                    data.previous = cmd['state']
+                    data.previous = state
                     data.diagnostic = diagnostic(failure)
                     logger.debug('%s : exception trapped -> (%s)' % (self.path, data.diagnostic))
                     self.actor_ref.tell({'fsm': {'state': 'reset', 'data': data}})
 
+            finally:
+
+                #
+                # - if tracing is on record how long the transition waited in our mailbox and how long
+                #   we spent in the state method
+                #
+                if tracer:
+                    tracer.entered(self.path, state, self.actor_inbox.waited, time.time() - started)
+
 
-class _Scheduled(Thread):
+class _Scheduled(object):
     """
-    Thread emulating a scheduled message (e.g posted to the state-machine after some delay.
+    Scheduled message (e.g posted to the state-machine after some delay). The message can be claimed beforehand, in
+    which case it will not be posted.
     """
 
     def __init__(self, ref, msg, lapse):
-        super(_Scheduled, self).__init__()
         assert lapse >= 0, 'invalid duration (cannot be negative)'
+        self.claimed = 0
+        self.deadline = time.time() + lapse
+        self.lock = Lock()
         self.ref = ref
         self.msg = msg
         self.lapse = lapse
+        self.pipe = None
+
+    def claim(self):
+
+        #
+        # - only the first caller gets to post the message
+        # - wake up the thread sleeping in run() if any
+        #
+        with self.lock:
+            claimed, self.claimed = self.claimed, 1
+            if not claimed and self.pipe:
+                os.write(self.pipe[1], 'x')
+
+        return not claimed
+
+    def post(self):
+
+        if not self.claim():
+            return
 
-    def run(self):
-        time.sleep(self.lapse)
         try:
             #
             # - the tell() can raise if ever the actor has been nuked in the meantime
@@ -401,6 +659,177 @@ class _Scheduled(Thread):
         except Exception:
             pass
 
+    def run(self):
+
+        #
+        # - block in select() on our own pipe until the deadline, claim() writes to it
+        # - this way an expedited transition does not leave a thread sleeping until the (possibly long) deadline
+        #   and we don't have to wake up periodically to find out (python 2 timed condition waits are polling)
+        #
+        with self.lock:
+            if self.claimed:
+                return
+
+            self.pipe = os.pipe()
+
+        try:
+            while not self.claimed:
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                select.select([self.pipe[0]], [], [], remaining)
+
+        finally:
+            with self.lock:
+                pipe, self.pipe = self.pipe, None
+
+            os.close(pipe[0])
+            os.close(pipe[1])
+
+        self.post()
+
+
+class _Timer(Thread):
+    """
+    Single thread posting scheduled messages once their deadline is reached, using a heap ordered by deadline.
+    Messages claimed in the meantime (e.g via wake()) are simply dropped when popped.
+
+    The thread blocks in select() on a self-pipe, using the next deadline as timeout, and is woken up by a write to
+    the pipe whenever a message becomes the next one due (python 2 timed condition waits are polling).
+    """
+
+    def __init__(self):
+        super(_Timer, self).__init__()
+
+        self.daemon = True
+        self.heap = []
+        self.lock = Lock()
+        self.pipe = os.pipe()
+        self.sequence = itertools.count()
+
+        #
+        # - never block when notifying (a full pipe means the timer thread will wake up anyway)
+        #
+        flags = fcntl.fcntl(self.pipe[1], fcntl.F_GETFL)
+        fcntl.fcntl(self.pipe[1], fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def schedule(self, scheduled):
+
+        #
+        # - the sequence number breaks ties between identical deadlines
+        # - only notify the timer thread if this message is now the next one due
+        #
+        with self.lock:
+            heapq.heappush(self.heap, (scheduled.deadline, next(self.sequence), scheduled))
+            notify = self.heap[0][2] is scheduled
+
+        if notify:
+            try:
+                os.write(self.pipe[1], 'x')
+
+            except OSError as failure:
+                if failure.errno != errno.EAGAIN:
+                    raise
+
+    def run(self):
+
+        while 1:
+
+            #
+            # - pop whatever is due and compute how long we can sleep for
+            #
+            due = []
+            with self.lock:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    _, _, scheduled = heapq.heappop(self.heap)
+                    due.append(scheduled)
+
+                timeout = self.heap[0][0] - now if self.heap else None
+
+            #
+            # - post outside of the lock (the actor mailbox may block if ever bounded)
+            #
+            for scheduled in due:
+                scheduled.post()
+
+            if due:
+                continue
+
+            #
+            # - sleep until the next deadline or until notified, then drain the pipe
+            #
+            readable, _, _ = select.select([self.pipe[0]], [], [], timeout)
+            if readable:
+                os.read(self.pipe[0], 4096)
+
+
+class _Inbox(Queue):
+    """
+    Actor mailbox time-stamping messages as they are posted, which allows us to know how long the message we
+    just picked waited. We also keep track of the mailbox depth, recent latencies and throughput. Please note
+    _put() and _get() are always invoked with the queue mutex held.
+    """
+
+    def _init(self, maxsize):
+
+        Queue._init(self, maxsize)
+        self.high_water = 0
+        self.latencies = deque(maxlen=1024)
+        self.path = '?'
+        self.peak = 0
+        self.processed = 0
+        self.since = time.time()
+        self.stamps = deque()
+        self.waited = 0.0
+        self.warned = 0
+
+    def _put(self, item):
+
+        Queue._put(self, item)
+        self.stamps.append(time.time())
+        depth = len(self.stamps)
+        self.peak = max(self.peak, depth)
+        if self.high_water and depth >= self.high_water and not self.warned:
+
+            #
+            # - we went above the high-water mark, log once (until the mailbox drains back to half of it)
+            #
+            self.warned = 1
+            logger.warning('%s : %d messages pending in the mailbox (backing up ?)' % (self.path, depth))
+
+    def _get(self):
+
+        self.waited = time.time() - self.stamps.popleft()
+        self.latencies.append(self.waited)
+        self.processed += 1
+        if self.warned and len(self.stamps) < self.high_water / 2:
+            self.warned = 0
+
+        return Queue._get(self)
+
+    def stats(self):
+
+        with self.mutex:
+            depth = len(self.stamps)
+            ordered = sorted(self.latencies)
+            processed = self.processed
+
+        def _percentile(pct):
+            return round(1000.0 * ordered[int(pct * (len(ordered) - 1))], 3) if ordered else 0.0
+
+        lapse = max(time.time() - self.since, 1e-3)
+        return \
+            {
+                'depth': depth,
+                'peak': self.peak,
+                'processed': processed,
+                'throughput (msg/s)': round(processed / lapse, 3),
+                'p50 (ms)': _percentile(0.5),
+                'p99 (ms)': _percentile(0.99)
+            }
+
 
 class _Container(dict):
     """
@@ -408,6 +837,39 @@ class _Container(dict):
     """
     pass
 
+
+class Coalesced(object):
+    """
+    Latest-wins mailbox slot shared between one or more producers and an actor. Producers post() values indexed by
+    key and only the first post() since the last drain() results in a message being sent to the actor, which then
+    drain()s everything that accumulated in the meantime. Successive values posted for a given key overwrite each
+    other, meaning a burst of updates is processed as one single message.
+    """
+
+    def __init__(self, actor_ref, request):
+
+        self.lock = Lock()
+        self.pending = {}
+        self.ref = actor_ref
+        self.request = request
+
+    def post(self, key, value):
+
+        with self.lock:
+            notify = not self.pending
+            self.pending[key] = value
+
+        if notify:
+            self.ref.tell({'request': self.request})
+
+    def drain(self):
+
+        with self.lock:
+            out, self.pending = self.pending, {}
+
+        return out
+
+
 def _kill(actor_ref):
     """
     Forcefully kill a pykka actor by emitting a 'pykka_stop' command and returns false if ever the actor
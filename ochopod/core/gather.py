@@ -0,0 +1,113 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import requests
+import time
+
+from Queue import Empty, Queue
+from threading import Lock, Thread
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+
+class Gatherer(object):
+    """
+    Sends the same HTTP POST to a set of pods concurrently (using at most *workers* threads) and aggregates their
+    json replies. Each pod gets *timeout* seconds to reply and the whole collection is bounded by *deadline* seconds
+    (any pod not queried or still pending by then is reported as failed). The aggregated replies are cached for *ttl*
+    seconds as long as the set of pods does not change. Only one collection runs at a time : concurrent callers wait
+    for it and get the same outcome.
+    """
+
+    def __init__(self, path='/info', workers=16, timeout=2.0, ttl=1.0, deadline=5.0):
+
+        self.cached = None
+        self.deadline = deadline
+        self.lock = Lock()
+        self.path = path
+        self.timeout = timeout
+        self.ttl = ttl
+        self.workers = workers
+
+    def collect(self, urls):
+        """
+        Returns the reply of each pod indexed by pod key. A pod failing to reply is mapped to a dict with an
+        *error* string.
+
+        :type urls: dict
+        :param urls: pod base URLs (e.g http://<ip>:<port>) indexed by pod key
+        :rtype: dict
+        """
+
+        members = sorted(urls.items())
+        with self.lock:
+            now = time.time()
+            if self.cached:
+                ts, previous, out = self.cached
+                if previous == members and now - ts < self.ttl:
+                    return out
+
+            out = self._fetch(members)
+            self.cached = time.time(), members, out
+            return out
+
+    def _fetch(self, members):
+
+        out = {}
+        deadline = time.time() + self.deadline
+        queue = Queue()
+        for member in members:
+            queue.put(member)
+
+        def _work():
+            while 1:
+                try:
+                    key, url = queue.get_nowait()
+
+                except Empty:
+                    return
+
+                #
+                # - don't start anything past the deadline and never wait beyond it
+                #
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+
+                try:
+                    reply = requests.post(url + self.path, timeout=min(self.timeout, remaining))
+                    out[key] = reply.json() if reply.status_code == 200 else {'error': 'HTTP %d' % reply.status_code}
+
+                except Exception as failure:
+                    out[key] = {'error': '%s (%s)' % (type(failure).__name__, failure)}
+
+        threads = [Thread(target=_work) for _ in range(min(self.workers, len(members)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+        #
+        # - whatever is still pending is reported as failed (a late reply ends up in the old dict and is dropped)
+        #
+        out = {key: out.get(key, {'error': 'deadline exceeded'}) for key, _ in members}
+        failed = sum(1 for js in out.values() if 'error' in js)
+        logger.debug('gathered %s from %d pods (%d failures)' % (self.path, len(members), failed))
+        return out
@@ -0,0 +1,272 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import time
+
+from copy import deepcopy
+from ochopod.core.fsm import diagnostic
+from threading import Lock
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+
+class Hints(dict):
+    """
+    Thread-safe versioned store holding the runtime pod settings shared between our actors and the HTTP endpoints.
+    Every mutation is atomic and bumps the version counter if it actually changes something (writing the same value
+    again is not a change). Several keys can be changed at once using update(). Readers can take consistent
+    snapshots, get a cached json serialization, block until the version moves on or subscribe to changes. Each key
+    also remembers the version it last changed at, which lets readers track a subset of the keys only (e.g a change
+    to any other key does not move the version of that subset).
+
+    Only top-level assignments are tracked, which is how the hints are always updated (values must never be edited
+    in place).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Hints, self).__init__(*args, **kwargs)
+
+        self.cache = {}
+        self.lock = Lock()
+        self.stamps = {}
+        self.subscribers = []
+        self.version = 0
+        self.waiters = []
+
+    def __deepcopy__(self, memo):
+
+        #
+        # - copies are plain dicts (e.g without the lock, which can't be copied)
+        #
+        with self.lock:
+            return deepcopy(dict(self), memo)
+
+    def __setitem__(self, key, value):
+
+        self.update({key: value})
+
+    def __delitem__(self, key):
+
+        with self.lock:
+            dict.__delitem__(self, key)
+            version = self._bump([key])
+
+        self._publish(version, [key])
+
+    def clear(self):
+
+        with self.lock:
+            keys = self.keys()
+            dict.clear(self)
+            version = self._bump(keys)
+
+        self._publish(version, keys)
+
+    def pop(self, key, *default):
+
+        with self.lock:
+            present = key in self
+            value = dict.pop(self, key, *default)
+            version = self._bump([key]) if present else None
+
+        if present:
+            self._publish(version, [key])
+
+        return value
+
+    def setdefault(self, key, default=None):
+
+        with self.lock:
+            if key in self:
+                return dict.__getitem__(self, key)
+
+            dict.__setitem__(self, key, default)
+            version = self._bump([key])
+
+        self._publish(version, [key])
+        return default
+
+    def update(self, *args, **kwargs):
+        """
+        Sets one or more keys atomically (e.g readers will either see all the new values or none of them). The
+        version is bumped once.
+        """
+
+        with self.lock:
+            keys = []
+            for key, value in dict(*args, **kwargs).items():
+                if key not in self or dict.__getitem__(self, key) != value:
+                    dict.__setitem__(self, key, value)
+                    keys.append(key)
+
+            if not keys:
+                return
+
+            version = self._bump(keys)
+
+        self._publish(version, keys)
+
+    def json(self, keys=None):
+        """
+        Returns the version of the specified keys (or the current version) along with their json serialization.
+        The serialization is cached until one of these keys changes.
+
+        :type keys: list
+        :param keys: optional list of keys to serialize
+        :rtype: (int, str) tuple
+        """
+
+        tag = tuple(keys) if keys else None
+        with self.lock:
+            version, body = self.cache.get(tag, (None, None))
+            if version != self._stamp(keys):
+                version, body = self._stamp(keys), json.dumps(self._subset(keys))
+                self.cache[tag] = version, body
+
+            return version, body
+
+    def snapshot(self, keys=None):
+        """
+        Returns the version of the specified keys (or the current version) along with a deep copy of these keys (or
+        of everything), atomically.
+
+        :type keys: list
+        :param keys: optional list of keys to copy (missing keys are skipped)
+        :rtype: (int, dict) tuple
+        """
+
+        with self.lock:
+            return self._stamp(keys), deepcopy(self._subset(keys))
+
+    def subscribe(self, callback):
+        """
+        Registers a callback invoked after each change with the new version and the list of keys that changed.
+        Callbacks are run by whatever thread changed the hints and must therefore be quick.
+
+        :type callback: callable
+        :param callback: invoked with (version, keys)
+        """
+
+        with self.lock:
+            self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+
+        #
+        # - compare by equality : bound methods are new objects each time they are accessed
+        #
+        with self.lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers if subscriber != callback]
+
+    def wait(self, version, timeout, keys=None):
+        """
+        Blocks until the version of the specified keys (or the current version) differs from the specified one or
+        until the timeout expires and returns that version.
+
+        :type version: int
+        :param version: the version we already know about
+        :type timeout: float
+        :param timeout: maximum time to wait, in seconds
+        :type keys: list
+        :param keys: optional list of keys to track
+        :rtype: int
+        """
+
+        #
+        # - block in select() on our own pipe which is written to upon each change
+        # - don't use a timed condition variable wait, it polls under python 2.7
+        #
+        deadline = time.time() + timeout
+        pipe = os.pipe()
+        fcntl.fcntl(pipe[1], fcntl.F_SETFL, fcntl.fcntl(pipe[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+        with self.lock:
+            self.waiters = self.waiters + [pipe[1]]
+
+        try:
+            while 1:
+                with self.lock:
+                    current = self._stamp(keys)
+
+                remaining = deadline - time.time()
+                if current != version or remaining <= 0:
+                    return current
+
+                if select.select([pipe[0]], [], [], remaining)[0]:
+                    os.read(pipe[0], 4096)
+
+        finally:
+            with self.lock:
+                self.waiters = [fd for fd in self.waiters if fd != pipe[1]]
+
+            os.close(pipe[0])
+            os.close(pipe[1])
+
+    def _bump(self, keys):
+
+        #
+        # - the lock must be held
+        # - stamp the keys that changed and wake up whoever is blocked in wait()
+        #
+        self.version += 1
+        for key in keys:
+            self.stamps[key] = self.version
+
+        for fd in self.waiters:
+            try:
+                os.write(fd, 'x')
+
+            except OSError as failure:
+                if failure.errno != errno.EAGAIN:
+                    raise
+
+        return self.version
+
+    def _publish(self, version, keys):
+
+        #
+        # - invoke the subscribers outside of the lock
+        # - trap any failure, we don't want to fail whoever changed the hints
+        #
+        for callback in self.subscribers:
+            try:
+                callback(version, keys)
+
+            except Exception as failure:
+                logger.warning('hints subscriber failed -> %s' % diagnostic(failure))
+
+    def _stamp(self, keys):
+
+        #
+        # - the lock must be held
+        #
+        if keys is None:
+            return self.version
+
+        return max([self.stamps.get(key, 0) for key in keys] or [0])
+
+    def _subset(self, keys):
+
+        if keys is None:
+            return dict(self)
+
+        return {key: dict.__getitem__(self, key) for key in keys if key in self}
@@ -0,0 +1,360 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import re
+import time
+
+from bisect import bisect_left
+from ochopod.core import trace
+from threading import Lock
+
+#: Default histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#: Zookeeper client methods timed by :func:`instrument`.
+OPERATIONS = ['create', 'delete', 'ensure_path', 'exists', 'get', 'get_children', 'set']
+
+#: Metrics registered so far, indexed by name.
+_metrics = {}
+
+#: Lock protecting the registry.
+_lock = Lock()
+
+
+def counter(name, doc, labels=()):
+    """
+    Registers a counter (or returns the one already registered under that name).
+
+    :type name: str
+    :param name: metric name, e.g 'ochopod_configurations_total'
+    :type doc: str
+    :param doc: one-liner describing the metric
+    :type labels: tuple
+    :param labels: label names
+    :rtype: :class:`Counter`
+    """
+    return _register(Counter, name, doc, labels)
+
+
+def gauge(name, doc, labels=()):
+    """
+    Registers a gauge (or returns the one already registered under that name).
+
+    :type name: str
+    :param name: metric name
+    :type doc: str
+    :param doc: one-liner describing the metric
+    :type labels: tuple
+    :param labels: label names
+    :rtype: :class:`Gauge`
+    """
+    return _register(Gauge, name, doc, labels)
+
+
+def histogram(name, doc, labels=(), buckets=BUCKETS):
+    """
+    Registers a histogram (or returns the one already registered under that name).
+
+    :type name: str
+    :param name: metric name, e.g 'ochopod_configuration_seconds'
+    :type doc: str
+    :param doc: one-liner describing the metric
+    :type labels: tuple
+    :param labels: label names
+    :type buckets: tuple
+    :param buckets: ascending bucket upper bounds
+    :rtype: :class:`Histogram`
+    """
+    return _register(Histogram, name, doc, labels, buckets)
+
+
+def exposition(extra=None):
+    """
+    Renders all the registered metrics using the prometheus text exposition format (version 0.0.4). Additional
+    metrics (e.g computed on the fly) can be passed as a list of :class:`Gauge` or :class:`Counter`.
+
+    :type extra: list
+    :param extra: optional list of unregistered metrics to render as well
+    :rtype: str
+    """
+    with _lock:
+        metrics = sorted(_metrics.values(), key=lambda metric: metric.name)
+
+    lines = []
+    for metric in metrics + (extra or []):
+        lines += metric.render()
+
+    return '\n'.join(lines) + '\n'
+
+
+def flatten(js, prefix='ochopod_user', doc='user metric (from sanity_check())'):
+    """
+    Turns a (possibly nested) dict of numbers into gauges, one per leaf, named after the path to that leaf. This is
+    how we expose whatever sanity_check() returned. Values that are not numbers are skipped. Keys that end up with
+    the same name once sanitized (e.g {'db': {'lag': 1}} and {'db-lag': 2}) map to one single gauge (the last one
+    walked wins).
+
+    :type js: dict
+    :param js: nested dict
+    :type prefix: str
+    :param prefix: name prefix
+    :type doc: str
+    :param doc: help string used for all the gauges
+    :rtype: list
+    """
+
+    out = {}
+
+    def _walk(node, path):
+        for key, value in sorted(node.items()):
+            name = '%s_%s' % (path, re.sub(r'[^a-zA-Z0-9_]', '_', str(key)))
+            if isinstance(value, dict):
+                _walk(value, name)
+
+            elif isinstance(value, (bool, int, long, float)):
+                metric = Gauge(name, doc)
+                metric.set(float(value))
+                out[name] = metric
+
+    #
+    # - a metric name must not show up twice in a scrape (prometheus would reject all of it)
+    #
+    _walk(js or {}, prefix)
+    return [out[name] for name in sorted(out)]
+
+
+def mailboxes():
+    """
+    Returns the depth and processed message count of each registered state-machine mailbox as metrics (see
+    :func:`ochopod.core.trace.mailboxes`).
+
+    :rtype: list
+    """
+    depth = Gauge('ochopod_mailbox_depth', 'messages pending in the actor mailbox', ('actor',))
+    processed = Counter('ochopod_mailbox_processed_total', 'messages processed by the actor', ('actor',))
+    for path, stats in trace.mailboxes().items():
+        depth.set(stats['depth'], actor=path)
+        processed.inc(stats['processed'], actor=path)
+
+    return [depth, processed]
+
+
+def instrument(zk):
+    """
+    Wraps a zookeeper client to count & time its operations (e.g whatever is listed in :data:`OPERATIONS`). Any
+    other attribute is passed through.
+
+    :type zk: :class:`kazoo.client.KazooClient`
+    :param zk: the zookeeper client
+    :rtype: :class:`_Instrumented`
+    """
+    return _Instrumented(zk)
+
+
+class _Metric(object):
+    """
+    Base class for our metrics, which hold one value per combination of label values. All methods are thread-safe.
+    """
+
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.name = name
+        self.values = {}
+
+    def render(self):
+
+        with self.lock:
+            values = sorted((key, self._copy(value)) for key, value in self.values.items())
+
+        lines = ['# HELP %s %s' % (self.name, self.doc), '# TYPE %s %s' % (self.name, self.kind)]
+        for key, value in values:
+            lines += self._render(dict(zip(self.labels, key)), value)
+
+        return lines
+
+    def _copy(self, value):
+
+        return value
+
+    def _key(self, labels):
+
+        assert set(labels) == set(self.labels), 'labels must be %s' % ', '.join(self.labels)
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _render(self, labels, value):
+
+        return ['%s%s %s' % (self.name, _labels(labels), _number(value))]
+
+
+class Counter(_Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+
+        #
+        # - each value is a list of per bucket counts (plus one extra slot for +Inf), the sum and the count
+        # - the counts are made cumulative when rendering
+        #
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            entry = self.values[key]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """
+        Returns a context manager observing how long its block took (in seconds).
+        """
+        return _Timer(self, labels)
+
+    def _copy(self, value):
+
+        return [value[0][:], value[1], value[2]]
+
+    def _render(self, labels, value):
+
+        counts, total, count = value
+        lines = []
+        cumulated = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulated += n
+            lines.append('%s_bucket%s %d' % (self.name, _labels(dict(labels, le=_number(bound))), cumulated))
+
+        lines.append('%s_sum%s %s' % (self.name, _labels(labels), _number(total)))
+        lines.append('%s_count%s %d' % (self.name, _labels(labels), count))
+        return lines
+
+
+class _Instrumented(object):
+    """
+    Zookeeper client proxy counting and timing the operations listed in :data:`OPERATIONS`. Failed operations are
+    counted as well (by exception type). The wrappers are built once and then cached on the proxy.
+    """
+
+    def __init__(self, zk):
+
+        self.zk = zk
+
+    def __getattr__(self, name):
+
+        attribute = getattr(self.zk, name)
+        if name not in OPERATIONS:
+            return attribute
+
+        def _timed(*args, **kwargs):
+            started = time.time()
+            outcome = 'ok'
+            try:
+                return attribute(*args, **kwargs)
+
+            except Exception as failure:
+                outcome = type(failure).__name__
+                raise
+
+            finally:
+                ZK.observe(time.time() - started, operation=name, outcome=outcome)
+
+        setattr(self, name, _timed)
+        return _timed
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *_):
+
+        self.histogram.observe(time.time() - self.started, **self.labels)
+
+
+def _labels(labels):
+
+    if not labels:
+        return ''
+
+    def _escape(value):
+        return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(str(value))) for key, value in sorted(labels.items()))
+
+
+def _number(value):
+
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+def _register(clz, name, doc, labels, *args):
+
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = clz(name, doc, labels, *args)
+
+        metric = _metrics[name]
+        assert isinstance(metric, clz), 'metric %s is already registered as a %s' % (name, metric.kind)
+        return metric
+
+
+#: Zookeeper operations latency, by operation and outcome (see :func:`instrument`).
+ZK = histogram('ochopod_zk_operation_seconds', 'zookeeper operation latency', ('operation', 'outcome'))
@@ -0,0 +1,212 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+
+#: Registration fields we expect from any pod (e.g what the bindings write to zookeeper). Any other field is kept
+#: in a small overflow dict.
+FIELDS = \
+    (
+        'application',
+        'binding',
+        'cluster',
+        'debug',
+        'fwk',
+        'ip',
+        'local',
+        'namespace',
+        'node',
+        'port',
+        'ports',
+        'public',
+        'seq',
+        'start',
+        'status',
+        'task',
+        'zk'
+    )
+
+#: Fields whose values are shared by most pods (and therefore interned).
+SHARED = frozenset(['application', 'binding', 'cluster', 'debug', 'fwk', 'local', 'namespace', 'node', 'port',
+                    'start', 'status', 'zk'])
+
+#: Marker used for fields that are not set.
+_UNSET = object()
+
+#: Interning table (we can't use intern() since json.loads() returns unicode strings).
+_interned = {}
+
+
+def _intern(value):
+
+    #
+    # - setdefault() is atomic, no need to lock
+    #
+    return _interned.setdefault(value, value) if isinstance(value, basestring) else value
+
+
+class PodRecord(object):
+    """
+    Compact read-only pod registration payload. It behaves like the dict it is parsed from (e.g record['ip'] or
+    record.get('public')) while using slots instead of a per-pod dict. Field names are shared by construction and
+    the most common values are interned, which matters when the leader holds thousands of pods and dependencies.
+
+    Use :meth:`js` to get a regular dict back or :func:`dumps` to serialize records to json.
+    """
+
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, js):
+
+        for key in FIELDS:
+            value = js.get(key, _UNSET)
+            setattr(self, key, _intern(value) if key in SHARED else value)
+
+        extra = {_intern(key): value for key, value in js.items() if key not in FIELDS}
+        self.extra = extra if extra else None
+
+    def __getitem__(self, key):
+
+        if key in FIELDS:
+            value = getattr(self, key)
+        else:
+            value = self.extra.get(key, _UNSET) if self.extra else _UNSET
+
+        if value is _UNSET:
+            raise KeyError(key)
+
+        return value
+
+    def __contains__(self, key):
+
+        try:
+            self[key]
+            return True
+
+        except KeyError:
+            return False
+
+    def __eq__(self, other):
+
+        if isinstance(other, PodRecord):
+            return all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+        return isinstance(other, dict) and self.js() == other
+
+    def __ne__(self, other):
+
+        return not self == other
+
+    __hash__ = None
+
+    def __copy__(self):
+
+        #
+        # - records are read-only, copies can share them (deepcopy() would otherwise clone the unset marker)
+        #
+        return self
+
+    def __deepcopy__(self, memo):
+
+        return self
+
+    def __getstate__(self):
+
+        return self.js()
+
+    def __setstate__(self, state):
+
+        self.__init__(state)
+
+    def __iter__(self):
+
+        return iter(self.keys())
+
+    def __len__(self):
+
+        return len(self.keys())
+
+    def __repr__(self):
+
+        return 'PodRecord(%r)' % self.js()
+
+    def get(self, key, default=None):
+
+        try:
+            return self[key]
+
+        except KeyError:
+            return default
+
+    def keys(self):
+
+        out = [key for key in FIELDS if getattr(self, key) is not _UNSET]
+        return out + self.extra.keys() if self.extra else out
+
+    def values(self):
+
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+
+        return [(key, self[key]) for key in self.keys()]
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+
+        return iter(self.values())
+
+    def iteritems(self):
+
+        return iter(self.items())
+
+    def js(self):
+        """
+        Returns the record as a regular dict (e.g what was originally registered by the pod).
+
+        :rtype: dict
+        """
+        return dict(self.items())
+
+
+def parse(pods):
+    """
+    Turns a dict of pod payloads (indexed by pod key) into a dict of :class:`PodRecord`. Values that already are
+    records are kept as-is.
+
+    :type pods: dict
+    :param pods: pod payloads, as parsed from json
+    :rtype: dict
+    """
+    return {key: js if isinstance(js, PodRecord) else PodRecord(js) for key, js in pods.items()}
+
+
+def dumps(obj, **kwargs):
+    """
+    Drop-in replacement for :func:`json.dumps` that knows how to serialize :class:`PodRecord` instances.
+
+    :type obj: anything
+    :param obj: what to serialize
+    :rtype: str
+    """
+
+    def _default(value):
+        if isinstance(value, PodRecord):
+            return value.js()
+        raise TypeError('%r is not JSON serializable' % value)
+
+    return json.dumps(obj, default=_default, **kwargs)
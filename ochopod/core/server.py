@@ -0,0 +1,211 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from Queue import Queue
+from threading import Thread
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+from werkzeug.wsgi import LimitedStream
+
+
+class Server(object):
+    """
+    Embedded HTTP server running a WSGI application (e.g our Flask endpoints) from a background thread. The server
+    is stopped directly (e.g without having to send it a request).
+    """
+
+    def __init__(self, app, host, port):
+
+        self.app = app
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def build(self):
+        """
+        Returns the underlying werkzeug server.
+
+        :rtype: :class:`werkzeug.serving.BaseWSGIServer`
+        """
+        raise NotImplementedError
+
+    def start(self):
+        """
+        Binds the server and serves requests from a daemon thread.
+        """
+
+        self.server = self.build()
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stops serving requests and closes the listening socket. This blocks until the serving loop exits.
+        """
+
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+
+class Threaded(Server):
+    """
+    The stock werkzeug server, spawning one thread per connection with no keep-alive (this is what Flask's run()
+    would give us).
+    """
+
+    def build(self):
+
+        return make_server(self.host, self.port, self.app, threaded=True)
+
+
+class Pooled(Server):
+    """
+    Werkzeug server handing its connections over to a fixed pool of worker threads. Connections are kept alive
+    (HTTP/1.1) until idle for more than *timeout* seconds, which is also how long a slow client may take to send its
+    request. Once all the workers are busy up to *pending* connections are queued and the server then stops accepting
+    until a worker frees up (e.g the kernel backlog absorbs the excess). A worker will close its connection after
+    responding if ever other connections are waiting.
+    """
+
+    def __init__(self, app, host, port, workers=16, pending=64, timeout=5.0):
+        super(Pooled, self).__init__(app, host, port)
+
+        self.pending = pending
+        self.timeout = timeout
+        self.workers = workers
+
+    def build(self):
+
+        return _Pool(self.host, self.port, self.app, self.workers, self.pending, self.timeout)
+
+    def stop(self):
+
+        server = self.server
+        super(Pooled, self).stop()
+        if server:
+            server.drain()
+
+
+#: Embedded servers that can be selected at boot time, by name.
+SERVERS = \
+    {
+        'pooled': Pooled,
+        'threaded': Threaded
+    }
+
+
+class _Handler(WSGIRequestHandler):
+
+    #
+    # - buffer the response and disable nagle : the headers and body otherwise go out in separate small writes
+    #   which on a kept-alive connection stall on the peer's delayed ACK
+    #
+    disable_nagle_algorithm = True
+
+    protocol_version = 'HTTP/1.1'
+
+    wbufsize = -1
+
+    def make_environ(self):
+
+        #
+        # - bound the request body to its content length (unless chunked) and keep track of it
+        #
+        environ = WSGIRequestHandler.make_environ(self)
+        if not environ.get('wsgi.input_terminated'):
+            try:
+                environ['wsgi.input'] = LimitedStream(self.rfile, int(environ.get('CONTENT_LENGTH') or 0))
+
+            except ValueError:
+                environ['wsgi.input'] = LimitedStream(self.rfile, 0)
+                self.close_connection = 1
+
+        self.body = environ['wsgi.input']
+        return environ
+
+    def handle_one_request(self):
+
+        self.body = None
+        WSGIRequestHandler.handle_one_request(self)
+        self.wfile.flush()
+
+        #
+        # - skip whatever is left of the request body (most of our endpoints don't read it), otherwise it would be
+        #   parsed as the next request on this connection
+        # - close the connection if the client goes away or is too slow
+        #
+        if self.body is not None and not self.close_connection:
+            try:
+                while self.body.read(64 * 1024):
+                    pass
+
+            except Exception:
+                self.close_connection = 1
+
+        #
+        # - don't hog a worker with an idle keep-alive connection if other connections are waiting
+        #
+        if not self.server.queue.empty():
+            self.close_connection = 1
+
+
+class _Pool(BaseWSGIServer):
+
+    multithread = True
+
+    def __init__(self, host, port, app, workers, pending, timeout):
+
+        handler = type('Handler', (_Handler,), {'timeout': timeout})
+        super(_Pool, self).__init__(host, port, app, handler=handler)
+
+        self.queue = Queue(maxsize=pending)
+        self.threads = [Thread(target=self._work) for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+
+        #
+        # - invoked from the serving loop : this blocks if ever the queue is full
+        #
+        self.queue.put((request, client_address))
+
+    def drain(self):
+
+        #
+        # - tell each worker to exit once the pending connections are processed
+        #
+        for _ in self.threads:
+            self.queue.put(None)
+
+    def _work(self):
+
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+
+            except Exception:
+                self.handle_error(request, client_address)
+
+            finally:
+                self.shutdown_request(request)
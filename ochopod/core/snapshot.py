@@ -0,0 +1,208 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import hashlib
+import json
+import logging
+
+from kazoo.exceptions import NodeExistsError, NoNodeError
+from ochopod.core.codec import CODECS
+from ochopod.core.record import dumps, parse
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Serialized snapshot size (in bytes) above which we switch to shards. Anything smaller is written as-is to the
+#: /snapshot node (which is what older pods expect). This sits just under the default 1MB zookeeper node limit : any
+#: snapshot older pods could read is still written inline, only the ones they never could are sharded.
+INLINE = 1000 * 1024
+
+#: Target serialized size (in bytes) of each shard, before compression.
+SHARD = 128 * 1024
+
+#: Key under which the manifest is stored in the /snapshot node (it can't clash with a pod key, which is a UUID).
+MANIFEST = '_manifest'
+
+
+def _bucket(key, n):
+
+    #
+    # - stable mapping from pod key to shard (e.g a pod stays in the same shard as long as the shard count does not
+    #   change, which means the other shards are left untouched when it changes)
+    #
+    return int(hashlib.md5(key).hexdigest()[:8], 16) % n
+
+
+class Writer(object):
+    """
+    Writes the pods of a cluster to its /snapshot node. Small snapshots are written inline as json. Larger ones are
+    split in shards stored under /shards and encoded with the compact codec, with /snapshot holding a manifest
+    listing them (along with the codec used). Shards are named after their content and are therefore immutable :
+    only the shards that changed are written, and readers only fetch the ones they don't already have.
+
+    The shards of the previous manifest are kept around to let readers finish, older ones are deleted.
+    """
+
+    #: Codec used to encode the shards.
+    codec = CODECS['compact']
+
+    def __init__(self, zk, prefix):
+
+        self.current = set()
+        self.orphans = 1
+        self.prefix = prefix
+        self.previous = set()
+        self.zk = zk
+
+    def write(self, pods):
+        """
+        Writes the specified pods.
+
+        :type pods: dict
+        :param pods: pod records indexed by pod key
+        """
+
+        names = []
+        js = dumps(pods)
+        if len(js) <= INLINE:
+            value = js
+
+        else:
+
+            #
+            # - spread the pods over enough shards to match our target size
+            # - the same pods always encode to the same shard (the compact codec sorts the keys)
+            # - write the shards we don't have yet, then the manifest
+            #
+            n = len(js) // SHARD + 1
+            buckets = [{} for _ in range(n)]
+            for key, pod in pods.items():
+                buckets[_bucket(key, n)][key] = pod
+
+            for bucket in buckets:
+                blob = self.codec.encode(bucket)
+                name = hashlib.md5(blob).hexdigest()
+                if name not in self.current and name not in self.previous:
+                    try:
+                        self.zk.create('%s/shards/%s' % (self.prefix, name), value=blob, makepath=True)
+
+                    except NodeExistsError:
+                        pass
+
+                names.append(name)
+
+            value = json.dumps({MANIFEST: {'codec': self.codec.name, 'shards': names, 'size': len(js)}})
+            logger.debug('snapshot @ %s : %d pods, %d shards' % (self.prefix, len(pods), n))
+
+        self.zk.set('%s/snapshot' % self.prefix, value)
+
+        #
+        # - drop whatever the manifest before the previous one used
+        # - the first time around also drop any shard left over by a previous leader
+        #
+        stale = self.previous - self.current - set(names)
+        if self.orphans:
+            try:
+                stale |= set(self.zk.get_children('%s/shards' % self.prefix)) - self.current - set(names)
+
+            except NoNodeError:
+                pass
+
+            self.orphans = 0
+
+        self.previous, self.current = self.current, set(names)
+        for name in stale:
+            try:
+                self.zk.delete('%s/shards/%s' % (self.prefix, name))
+
+            except NoNodeError:
+                pass
+
+
+class Reader(object):
+    """
+    Reads the /snapshot nodes written by :class:`Writer` (or by older pods) and turns them into pod records. The
+    shards of each cluster are cached, meaning a new manifest only costs us the shards that changed.
+    """
+
+    def __init__(self, zk):
+
+        self.cache = {}
+        self.zk = zk
+
+    def read(self, prefix, watch=None):
+        """
+        Returns the pods of the specified cluster, as a dict of :class:`ochopod.core.record.PodRecord` indexed by
+        pod key. A missing or invalid snapshot maps to an empty dict. None is returned if the manifest refers to a
+        shard that is already gone (which means it has been replaced in the meantime and the watch will fire).
+
+        :type prefix: str
+        :param prefix: cluster zookeeper path (e.g /ochopod/clusters/<namespace>.<cluster>)
+        :type watch: callable
+        :param watch: optional watch to leave on the /snapshot node
+        :rtype: dict
+        """
+
+        path = '%s/snapshot' % prefix
+        try:
+
+            #
+            # - make sure we leave a watch even if the node does not exist yet
+            #
+            if not self.zk.exists(path, watch=watch):
+                return {}
+
+            value, _ = self.zk.get(path, watch=watch)
+            js = json.loads(value)
+
+        except (NoNodeError, ValueError):
+            return {}
+
+        if MANIFEST not in js:
+            self.cache.pop(prefix, None)
+            return parse(js)
+
+        pods = {}
+        shards = {}
+        manifest = js[MANIFEST]
+        cached = self.cache.get(prefix, {})
+        for name in manifest['shards']:
+            if name not in cached:
+                try:
+                    blob, _ = self.zk.get('%s/shards/%s' % (prefix, name))
+                    cached[name] = parse(CODECS[manifest['codec']].decode(blob))
+
+                except NoNodeError:
+                    return None
+
+            shards[name] = cached[name]
+            pods.update(shards[name])
+
+        #
+        # - only keep the shards used by this manifest
+        #
+        self.cache[prefix] = shards
+        return pods
+
+    def forget(self, prefix):
+        """
+        Drops the cached shards for the specified cluster.
+
+        :type prefix: str
+        :param prefix: cluster zookeeper path
+        """
+
+        self.cache.pop(prefix, None)
@@ -0,0 +1,161 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import time
+
+from threading import Lock
+
+#: Tracer collecting per-state statistics for all our state-machines, None unless tracing is switched on.
+TRACER = None
+
+#: Mailboxes of our running state-machines, indexed by actor path (always on).
+_mailboxes = {}
+
+#: Lock protecting the mailbox registry.
+_lock = Lock()
+
+
+def enable():
+    """
+    Switches state-machine tracing on (this is a process-wide setting). Calling it more than once is harmless.
+
+    :rtype: :class:`Tracer`
+    """
+    global TRACER
+    if TRACER is None:
+        TRACER = Tracer()
+
+    return TRACER
+
+
+def register(path, inbox):
+    """
+    Registers the mailbox of a state-machine (replacing any previous one using the same path).
+
+    :type path: str
+    :param path: actor path, e.g 'coordinator'
+    :type inbox: :class:`Queue.Queue`
+    :param inbox: actor mailbox exposing a stats() method
+    """
+    with _lock:
+        _mailboxes[path] = inbox
+
+
+def unregister(path, inbox):
+    """
+    Removes the mailbox of a state-machine from the registry (if still registered).
+
+    :type path: str
+    :param path: actor path, e.g 'coordinator'
+    :type inbox: :class:`Queue.Queue`
+    :param inbox: actor mailbox
+    """
+    with _lock:
+        if _mailboxes.get(path) is inbox:
+            del _mailboxes[path]
+
+
+def mailboxes():
+    """
+    Returns the depth, latency percentiles and throughput of each registered mailbox, indexed by actor path.
+
+    :rtype: dict
+    """
+    with _lock:
+        registered = _mailboxes.items()
+
+    return {path: inbox.stats() for path, inbox in registered}
+
+
+class Tracer(object):
+    """
+    Thread-safe recorder tracking, for each actor path and state, how many times the state was entered, how long
+    was spent inside the state method, how long the transition waited in the actor mailbox and how many times
+    the state retried or failed (and reset the machine).
+    """
+
+    def __init__(self):
+
+        self.lock = Lock()
+        self.since = time.time()
+        self.states = {}
+
+    def entered(self, path, state, waited, spent):
+
+        with self.lock:
+            stats = self._stats(path, state)
+            stats['entries'] += 1
+            stats['spent'] += spent
+            stats['max spent'] = max(stats['max spent'], spent)
+            stats['waited'] += waited
+            stats['max waited'] = max(stats['max waited'], waited)
+
+    def retried(self, path, state, attempt=1):
+
+        with self.lock:
+            stats = self._stats(path, state)
+            stats['retries'] += 1
+            stats['max retries'] = max(stats['max retries'], attempt)
+
+    def failed(self, path, state):
+
+        with self.lock:
+            self._stats(path, state)['resets'] += 1
+
+    def snapshot(self):
+        """
+        Returns what was recorded so far as a json-friendly dict (with durations in milliseconds).
+
+        :rtype: dict
+        """
+
+        def _ms(seconds):
+            return round(seconds * 1000.0, 3)
+
+        with self.lock:
+            actors = {}
+            for (path, state), stats in self.states.items():
+                actors.setdefault(path, {})[state] = \
+                    {
+                        'entries': stats['entries'],
+                        'spent (ms)': _ms(stats['spent']),
+                        'max spent (ms)': _ms(stats['max spent']),
+                        'waited (ms)': _ms(stats['waited']),
+                        'max waited (ms)': _ms(stats['max waited']),
+                        'retries': stats['retries'],
+                        'max retries': stats['max retries'],
+                        'resets': stats['resets']
+                    }
+
+            return {'uptime': int(time.time() - self.since), 'actors': actors}
+
+    def _stats(self, path, state):
+
+        key = (path, state)
+        if key not in self.states:
+            self.states[key] = \
+                {
+                    'entries': 0,
+                    'spent': 0.0,
+                    'max spent': 0.0,
+                    'waited': 0.0,
+                    'max waited': 0.0,
+                    'retries': 0,
+                    'max retries': 0,
+                    'resets': 0
+                }
+
+        return self.states[key]
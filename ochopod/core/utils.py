@@ -14,15 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import random
 import time
 
-from copy import deepcopy
 from subprocess import Popen, PIPE, STDOUT
 
 
 def merge(left, right):
     """
-    Recursive dict merge handling nested lists & dicts.
+    Recursive dict merge handling nested lists & dicts. The merge is copy-on-write : only the dicts and lists
+    along the paths being modified are copied, anything else is shared with the inputs (which are left untouched).
+    Treat the outcome as immutable.
 
     :type left: dict
     :param left: dict to be merged
@@ -34,19 +36,79 @@ def merge(left, right):
     if not isinstance(right, dict):
         return right
 
-    merged = deepcopy(left)
+    merged = dict(left)
     for k, v in right.iteritems():
         if k in merged and isinstance(merged[k], dict):
             merged[k] = merge(merged[k], v)
         elif k in merged and isinstance(v, list) and isinstance(merged[k], list):
-            merged[k] = merged[k] + deepcopy(v)
+            merged[k] = merged[k] + v
         else:
-            merged[k] = deepcopy(v)
+            merged[k] = v
 
     return merged
 
 
-def retry(timeout, pause=5.0, default=None):
+class Backoff(object):
+    """
+    Exponential backoff policy with jitter. The pause before the nth re-try (starting at 0) is base * factor^n
+    capped to a maximum and then randomly shortened by up to a jitter fraction. This spreads re-tries over time
+    and prevents a large number of pods from hitting the same resource (e.g zookeeper) in lockstep.
+
+    An optional maximum elapsed time can be specified, in which case :meth:`expired` will tell when to give up.
+    """
+
+    def __init__(self, base=1.0, factor=2.0, cap=30.0, jitter=0.5, max_elapsed=None):
+        """
+        :type base: float
+        :param base: pause in seconds before the first re-try
+        :type factor: float
+        :param factor: multiplier applied to the pause after each re-try
+        :type cap: float
+        :param cap: maximum pause in seconds
+        :type jitter: float
+        :param jitter: fraction of the pause that is randomized (0 for none, 1 for full jitter)
+        :type max_elapsed: float
+        :param max_elapsed: optional maximum amount of time in seconds we will keep re-trying for
+        """
+
+        assert base >= 0, 'the base pause must be positive'
+        assert factor >= 1.0, 'the factor must be at least 1'
+        assert 0.0 <= jitter <= 1.0, 'the jitter must be between 0 and 1'
+
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.jitter = jitter
+        self.max_elapsed = max_elapsed
+
+    def delay(self, attempt):
+        """
+        Returns how long to pause for before the specified re-try.
+
+        :type attempt: int
+        :param attempt: re-try index, starting at 0
+        :rtype: float
+        """
+
+        #
+        # - cap the exponent as well to avoid overflowing on long outages
+        #
+        pause = min(self.cap, self.base * self.factor ** min(attempt, 64))
+        return pause * (1.0 - self.jitter * random.random())
+
+    def expired(self, elapsed):
+        """
+        Tells whether or not we should give up re-trying.
+
+        :type elapsed: float
+        :param elapsed: amount of time in seconds since the first failure
+        :rtype: bool
+        """
+
+        return self.max_elapsed is not None and elapsed > self.max_elapsed
+
+
+def retry(timeout, pause=5.0, default=None, backoff=None):
     """
     Decorator implementing a simple unconditional re-try policy, e.g it will invoke the decorated
     method again upon any exception. If we keep invoking for too long a :class:`AssertionError` will be
@@ -58,11 +120,14 @@ def retry(timeout, pause=5.0, default=None):
     :param pause: amount of time in seconds we'll pause for before retrying
     :type default: anything
     :param default: optional value to return upon a timeout
+    :type backoff: :class:`Backoff`
+    :param backoff: optional backoff policy, in which case the pause is ignored
     """
 
     def decorator(func):
         def wrapper(*args, **kwargs):
             ts = time.time()
+            attempt = 0
             while 1:
                 try:
 
@@ -70,13 +135,15 @@ def retry(timeout, pause=5.0, default=None):
 
                 except Exception as _:
 
-                    bad = time.time() - ts > timeout
+                    elapsed = time.time() - ts
+                    bad = elapsed > timeout or (backoff is not None and backoff.expired(elapsed))
                     if bad and default is None:
                         assert 0, 'timeout exceeded @ %s()' % func.__name__
                     elif bad:
                         return default
                     else:
-                        time.sleep(pause)
+                        time.sleep(backoff.delay(attempt) if backoff else pause)
+                        attempt += 1
 
         return wrapper
     return decorator
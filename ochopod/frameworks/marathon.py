@@ -19,28 +19,35 @@ import logging
 import ochopod
 import os
 import tempfile
-import threading
 import time
 import shutil
+import uuid
 
 from argparse import ArgumentParser
-from copy import deepcopy
 from ochopod.api import Binding, LifeCycle, Model, Tool
+from ochopod.core import metrics, trace
+from ochopod.core.codec import CODECS
 from ochopod.core.core import Coordinator
-from ochopod.core.fsm import diagnostic, shutdown, spin_lock
+from ochopod.core.fsm import diagnostic, share_timer, shutdown, spin_lock
+from ochopod.core.gather import Gatherer
+from ochopod.core.hints import Hints
+from ochopod.core.server import SERVERS
 from ochopod.core.utils import shell
 from ochopod.models.reactive import Actor as Reactive
 from os import path
 from pykka import ThreadingFuture
 from pykka.exceptions import Timeout, ActorDeadError
+from threading import BoundedSemaphore
 from flask import Flask, request
-from requests import post
 from urlparse import urlparse
 from werkzeug.exceptions import default_exceptions, HTTPException
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Latency of the control requests handled by the pod, by task and HTTP code.
+CONTROL_TIME = metrics.histogram('ochopod_control_seconds', 'control request latency', ('task', 'code'))
+
 
 class Marathon(Binding):
     """
@@ -53,9 +60,20 @@ class Marathon(Binding):
 
         - *ochopod_cluster*: identifier for the cluster to run this pod under (e.g "database" or "web-server"
           for instance, defaulted to the Marathon application identifier if not specified).
+        - *ochopod_codec*: codec used to write the pod registration payload, either "json" (the default) or
+          "compact" (only set it once all the pods reading this cluster support it).
         - *ochopod_debug*: turns debug logging on if set to "true".
         - *ochopod_namespace*: namespace as dot separated tokens (e.g "my-app.staging"), defaulted to "marathon".
         - *ochopod_port*: pod control port on which we listen for HTTP requests, defaulted to 8080.
+        - *ochopod_publish*: publishes the live pod status (process, state, status and metrics) to zookeeper if
+          set to "true" (rate-limited and only upon change).
+        - *ochopod_server*: embedded HTTP server, either "threaded" (one thread per connection, the default) or
+          "pooled" (bounded pool of worker threads with keep-alive and request timeouts).
+        - *ochopod_timer*: set to "shared" to post the delayed state-machine transitions from one single thread
+          instead of one thread per pending transition (useful when packing many pods per host).
+        - *ochopod_trace*: turns state-machine tracing on if set to "true" (the statistics are returned by /stats
+          along with the mailbox statistics).
+        - *ochopod_workers*: number of worker threads when using the "pooled" HTTP server, defaulted to 16.
         - *ochopod_zk*: location of ZK ensemble, default to an empty string. This string must be a well formed ZK URL
          for instance zk://127.0.0.1:2181
 
@@ -74,6 +92,7 @@ class Marathon(Binding):
         - **ip**: local IPv4 for the resource on which the pod is running.
         - **public**: externally reachable resource IPv4 (used for the CLI or 3rd party integrations if applicable).
         - **zk**: connection string for our ZK ensemble.
+        - **codecs**: codecs the pod can decode (the leader uses the most compact one to send control requests).
     """
 
     def get_node_details(self):
@@ -110,12 +129,15 @@ class Marathon(Binding):
             {
                 'ochopod_application':  '',
                 'ochopod_cluster':      'default',
+                'ochopod_codec':        'json',
                 'ochopod_debug':        'true',
                 'ochopod_local':        'false',
                 'ochopod_namespace':    'marathon',
                 'ochopod_port':         '8080',
+                'ochopod_server':       'threaded',
                 'ochopod_start':        'true',
                 'ochopod_task':         '',
+                'ochopod_workers':      '16',
                 'ochopod_zk':           '',
                 'PORT_8080':            '8080'
             }
@@ -139,7 +161,7 @@ class Marathon(Binding):
             # - default all our settings, especially the mandatory ones
             # - the ip and zookeeper are defaulted to localhost to enable easy testing
             #
-            hints = {k[8:]: v for k, v in env.items() if k.startswith('ochopod_')}
+            hints = Hints({k[8:]: v for k, v in env.items() if k.startswith('ochopod_')})
             if local or hints['local'] == 'true':
 
                 #
@@ -242,6 +264,25 @@ class Marathon(Binding):
             #
             assert hints['zk'], 'unable to determine where zookeeper is located (unsupported/bogus mesos setup ?)'
             assert hints['cluster'] and hints['namespace'], 'no cluster and/or namespace defined (user error ?)'
+            assert hints['codec'] in CODECS, 'unsupported codec "%s" (user error ?)' % hints['codec']
+            assert hints['server'] in SERVERS, 'unsupported HTTP server "%s" (user error ?)' % hints['server']
+            assert hints['workers'].isdigit() and int(hints['workers']) > 0, \
+                'invalid HTTP worker count "%s" (user error ?)' % hints['workers']
+
+            #
+            # - switch state-machine tracing on if requested
+            # - this must be done before starting any actor
+            #
+            if hints.get('trace') == 'true':
+                logger.info('state-machine tracing is on')
+                trace.enable()
+
+            #
+            # - same thing for the shared timer
+            #
+            if hints.get('timer') == 'shared':
+                logger.info('using a shared timer for the state-machines')
+                share_timer()
 
             #
             # - load the tools
@@ -261,10 +302,10 @@ class Marathon(Binding):
             #
             latch = ThreadingFuture()
             logger.info('starting %s.%s (marathon) @ %s' % (hints['namespace'], hints['cluster'], hints['node']))
-            breadcrumbs = deepcopy(hints)
-            hints['metrics'] = {}
-            hints['dependencies'] = model.depends_on
-            env.update({'ochopod': json.dumps(hints)})
+            _, breadcrumbs = hints.snapshot()
+            breadcrumbs['codecs'] = sorted(CODECS.keys())
+            hints.update({'metrics': {}, 'dependencies': model.depends_on})
+            env.update({'ochopod': hints.json()[1]})
             executor = lifecycle.start(env, latch, hints)
             coordinator = Coordinator.start(
                 hints['zk'].split(','),
@@ -293,8 +334,16 @@ class Marathon(Binding):
             # - this is a subset of what's registered in zookeeper at boot-time
             # - the data is dynamic and updated from time to time by the model and executor actors
             # - from @pferro -> the pod's dependencies defined in the model are now added as well
+            # - the serialized body is cached by the hints, the version of its keys is used as the ETag
+            # - a request with a matching If-None-Match header gets a HTTP 304 (NOT MODIFIED), unless these keys
+            #   change within the optional ?wait=<seconds> long-poll window (capped to one minute)
+            # - the pooled server only lets half of its workers block on a long-poll (the others are needed for
+            #   /control), any long-poll beyond that gets its HTTP 304 right away
             #
-            @web.route('/info', methods=['POST'])
+            nonce = uuid.uuid4().hex[:8]
+            polls = BoundedSemaphore(int(hints['workers']) // 2) if hints['server'] == 'pooled' else None
+
+            @web.route('/info', methods=['GET', 'POST'])
             def _info():
 
                 logger.debug('http in -> /info')
@@ -314,8 +363,95 @@ class Marathon(Binding):
                         'task'
                     ]
 
-                subset = dict(filter(lambda i: i[0] in keys, hints.iteritems()))
-                return json.dumps(subset), 200, {'Content-Type': 'application/json; charset=utf-8'}
+                def _etag(version):
+                    return '"%s.%d"' % (nonce, version)
+
+                version, body = hints.json(keys)
+                if request.headers.get('If-None-Match') == _etag(version):
+                    try:
+                        wait = min(float(request.args.get('wait', 0)), 60.0)
+
+                    except ValueError:
+                        wait = None
+
+                    if wait is None or wait != wait:
+
+                        #
+                        # - fail on a HTTP 400 if ?wait is not a number (or is NaN)
+                        #
+                        return '{}', 400, {'Content-Type': 'application/json; charset=utf-8'}
+
+                    if wait <= 0 or (polls is not None and not polls.acquire(False)):
+                        return '', 304, {'ETag': _etag(version)}
+
+                    try:
+                        if hints.wait(version, wait, keys) == version:
+                            return '', 304, {'ETag': _etag(version)}
+
+                    finally:
+                        if polls is not None:
+                            polls.release()
+
+                    version, body = hints.json(keys)
+
+                headers = \
+                    {
+                        'Content-Type': 'application/json; charset=utf-8',
+                        'ETag': _etag(version)
+                    }
+
+                return body, 200, headers
+
+            #
+            # - external hook available on the leader only, returning the /info of every pod in the cluster
+            # - the requests are sent concurrently by a bounded pool, with a per-pod timeout and an overall deadline
+            #   (a pod failing to reply in time is reported with an error string)
+            # - the aggregated outcome is cached for a short while
+            # - fail on a HTTP 404 if we are not leading
+            #
+            gatherer = Gatherer('/info')
+
+            @web.route('/cluster/info', methods=['GET', 'POST'])
+            def _cluster_info():
+
+                logger.debug('http in -> /cluster/info')
+                _, js = hints.snapshot(['cluster', 'members', 'namespace', 'state'])
+                if 'members' not in js or not js.get('state', '').startswith('leader'):
+                    return '{}', 404, {'Content-Type': 'application/json; charset=utf-8'}
+
+                pods = gatherer.collect(js['members'])
+                js = \
+                    {
+                        'cluster': '%s.%s' % (js['namespace'], js['cluster']),
+                        'failed': sum(1 for info in pods.values() if 'error' in info),
+                        'pods': pods
+                    }
+
+                return json.dumps(js), 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+            #
+            # - external hook exposing our state-machine statistics
+            # - the mailbox statistics (depth, latency, throughput) are always returned
+            # - the per actor and state statistics are added if tracing is on
+            #
+            @web.route('/stats', methods=['GET', 'POST'])
+            def _stats():
+
+                logger.debug('http in -> /stats')
+                js = trace.TRACER.snapshot() if trace.TRACER else {}
+                js['mailboxes'] = trace.mailboxes()
+                return json.dumps(js), 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+            #
+            # - external hook exposing our metrics using the prometheus text format
+            # - the mailbox depths and whatever sanity_check() returned are computed on the fly
+            #
+            @web.route('/metrics', methods=['GET'])
+            def _metrics():
+
+                logger.debug('http in -> /metrics')
+                extra = metrics.mailboxes() + metrics.flatten(hints.get('metrics'))
+                return metrics.exposition(extra), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
             #
             # - external hook exposing our circular log
@@ -415,7 +551,8 @@ class Marathon(Binding):
 
             #
             # - web-hook used to receive requests from the leader or the CLI tools
-            # - those requests are passed down to the executor actor
+            # - those requests are passed down to the executor actor along with their content type (which tells what
+            #   codec the payload is encoded with)
             # - any non HTTP 200 response is a failure
             # - failure to acknowledge within the specified timeout will result in a HTTP 408 (REQUEST TIMEOUT)
             # - attempting to send a control request to a dead pod will result in a HTTP 410 (GONE)
@@ -436,10 +573,11 @@ class Marathon(Binding):
 
                     ts = time.time()
                     latch = ThreadingFuture()
-                    executor.tell({'request': task, 'latch': latch, 'data': request.data})
+                    executor.tell({'request': task, 'latch': latch, 'data': request.data, 'type': request.content_type})
                     js, code = latch.get(timeout=int(timeout))
-                    ms = time.time() - ts
-                    logger.debug('http out -> HTTP %s (%d ms)' % (code, ms))
+                    lapse = time.time() - ts
+                    CONTROL_TIME.observe(lapse, task=task, code=code)
+                    logger.debug('http out -> HTTP %s (%d ms)' % (code, int(lapse * 1000)))
                     return json.dumps(js), code, {'Content-Type': 'application/json; charset=utf-8'}
 
                 except Timeout:
@@ -448,6 +586,7 @@ class Marathon(Binding):
                     # - we failed to match the specified timeout
                     # - gracefully fail on a HTTP 408
                     #
+                    CONTROL_TIME.observe(time.time() - ts, task=task, code=408)
                     return '{}', 408, {'Content-Type': 'application/json; charset=utf-8'}
 
                 except ActorDeadError:
@@ -456,34 +595,23 @@ class Marathon(Binding):
                     # - the executor has been shutdown (probably after a /control/kill)
                     # - gracefully fail on a HTTP 410
                     #
+                    CONTROL_TIME.observe(time.time() - ts, task=task, code=410)
                     return '{}', 410, {'Content-Type': 'application/json; charset=utf-8'}
 
             #
-            # - internal hook required to shutdown the web-server
-            # - it's not possible to do it outside of a request handler
-            # - make sure this calls only comes from localhost (todo)
+            # - run the embedded server selected via $ochopod_server from a separate thread to avoid blocking
+            #   the main one
             #
-            @web.route('/terminate', methods=['POST'])
-            def _terminate():
-
-                request.environ.get('werkzeug.server.shutdown')()
-                return '{}', 200, {'Content-Type': 'application/json; charset=utf-8'}
-
-            #
-            # - run werkzeug from a separate thread to avoid blocking the main one
-            # - we'll have to shut it down using a dedicated HTTP POST
-            #
-            class _Runner(threading.Thread):
-
-                def run(self):
-                    web.run(host='0.0.0.0', port=int(hints['port']), threaded=True)
+            server = SERVERS[hints['server']](web, '0.0.0.0', int(hints['port']))
+            if hints['server'] == 'pooled':
+                server.workers = int(hints['workers'])
 
             try:
 
                 #
                 # - block on the lifecycle actor until it goes down (usually after a /control/kill request)
                 #
-                _Runner().start()
+                server.start()
                 spin_lock(latch)
                 logger.debug('pod is dead, idling')
                 while 1:
@@ -500,11 +628,11 @@ class Marathon(Binding):
                 #
                 # - when we exit the block first shutdown our executor (which may probably be already down)
                 # - then shutdown the coordinator to un-register from zookeeper
-                # - finally ask werkzeug to shutdown via a REST call
+                # - finally stop the embedded server
                 #
                 shutdown(executor)
                 shutdown(coordinator)
-                post('http://127.0.0.1:%s/terminate' % env['ochopod_port'])
+                server.stop()
 
         except KeyboardInterrupt:
 
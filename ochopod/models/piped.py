@@ -14,17 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import json
 import logging
 import pykka
 import time
 import os
 
+from bisect import bisect_left
 from collections import deque
-from copy import deepcopy
 from ochopod.api import Cluster, Piped
-from ochopod.core.core import SAMPLING
+from ochopod.core import metrics
+from ochopod.core.codec import decode
+from ochopod.core.core import IDLE, SAMPLING
 from ochopod.core.fsm import Aborted, FSM, diagnostic
+from ochopod.core.record import parse
 from pykka import ThreadingFuture
 from subprocess import Popen, PIPE, STDOUT
 from threading import Thread
@@ -32,19 +34,30 @@ from threading import Thread
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Sanity checks run against the sub-process, by outcome.
+CHECKS = metrics.counter('ochopod_sanity_checks_total', 'sanity checks run against the sub-process', ('outcome',))
+
+#: Sub-process restarts following an abnormal exit.
+RESTARTS = metrics.counter('ochopod_process_restarts_total', 'sub-process restarts following an abnormal exit')
+
+
 class _Cluster(Cluster):
     """
     Wrapper packaging the leader information in a user-friendly way and providing a dependency lookup
-    helper.
+    helper. Key orderings, lookup tables and connection strings are computed once and cached (a new instance is
+    built for each configuration).
     """
 
     def __init__(self, js):
         super(_Cluster, self).__init__()
 
         self.key = js['key']
-        self.pods = js['pods']
-        self.dependencies = js['dependencies']
-        self.index = sorted(self.pods.keys()).index(self.key)
+        self.pods = parse(js['pods'])
+        self.dependencies = {key: parse(pods) for key, pods in js['dependencies'].items()}
+        self.ordered = {None: sorted(self.pods.keys())}
+        self.cnxstrings = {}
+        self.tables = {}
+        self.index = bisect_left(self.ordered[None], self.key)
         self.seq = self.pods[self.key]['seq']
         self.size = len(self.pods)
 
@@ -53,13 +66,65 @@ class _Cluster(Cluster):
         if not dependency in self.dependencies:
             return ''
 
-        out = []
-        nodes = self.dependencies[dependency]
-        for node in nodes.values():
-            ip = node['public' if public else 'ip']
-            assert str(port) in node['ports'], 'pod from %s not exposing port %d ?' % (dependency, port)
-            out.append('%s:%d' % (ip, node['ports'][str(port)]))
-        return ','.join(out)
+        #
+        # - the connection string is built once for a given dependency, port and IP flavor
+        # - pay attention to order the pods to guarantee the same string across calls and pods
+        #
+        tag = (dependency, port, public)
+        if tag not in self.cnxstrings:
+            out = []
+            nodes = self.dependencies[dependency]
+            for key in self._ordered(dependency):
+                node = nodes[key]
+                ip = node['public' if public else 'ip']
+                assert str(port) in node['ports'], 'pod from %s not exposing port %d ?' % (dependency, port)
+                out.append('%s:%d' % (ip, node['ports'][str(port)]))
+            self.cnxstrings[tag] = ','.join(out)
+
+        return self.cnxstrings[tag]
+
+    def by_seq(self, seq, dependency=None):
+
+        return self._table(dependency)['seq'].get(seq)
+
+    def by_node(self, node, dependency=None):
+
+        return self._table(dependency)['node'].get(node, [])
+
+    def by_ip(self, ip, dependency=None):
+
+        return self._table(dependency)['ip'].get(ip, [])
+
+    def _ordered(self, dependency):
+
+        #
+        # - sort the pod keys for either our cluster (None) or a dependency
+        #
+        if dependency not in self.ordered:
+            self.ordered[dependency] = sorted(self.dependencies.get(dependency, {}).keys())
+
+        return self.ordered[dependency]
+
+    def _table(self, dependency):
+
+        #
+        # - index the pods once by sequence counter, node and ip (both internal and public)
+        # - the keys are always listed in order
+        #
+        if dependency not in self.tables:
+            table = {'seq': {}, 'node': {}, 'ip': {}}
+            pods = self.pods if dependency is None else self.dependencies.get(dependency, {})
+            for key in self._ordered(dependency):
+                pod = pods[key]
+                table['seq'][pod.get('seq')] = key
+                table['node'].setdefault(pod.get('node'), []).append(key)
+                for ip in set([pod.get('ip'), pod.get('public')]):
+                    if ip:
+                        table['ip'].setdefault(ip, []).append(key)
+
+            self.tables[dependency] = table
+
+        return self.tables[dependency]
 
 
 class Actor(FSM, Piped):
@@ -246,6 +311,7 @@ class Actor(FSM, Piped):
                         self.hints['metrics'] = {} if js is None else js
                         data.checks = self.checks
                         data.failed = 0
+                        CHECKS.inc(outcome='success')
 
                     except Exception as failure:
 
@@ -255,6 +321,7 @@ class Actor(FSM, Piped):
                         #
                         data.checks -= 1
                         data.failed = 0
+                        CHECKS.inc(outcome='failure')
                         logger.warning('%s : sanity check (%d/%d) failed -> %s' %
                                        (self.path, self.checks - data.checks, self.checks, diagnostic(failure)))
 
@@ -283,6 +350,7 @@ class Actor(FSM, Piped):
                     # - restart it gracefully
                     #
                     data.failed += 1
+                    RESTARTS.inc()
                     logger.error('%s : pid %s died (code %d), re-running' % (self.path, data.sub.pid, code))
                     self._request(['off', 'on'])
 
@@ -293,7 +361,15 @@ class Actor(FSM, Piped):
             #
             self.hints['metrics'] = {}
 
-        return 'spin', data, SAMPLING
+        #
+        # - run the next command right away if we just scheduled one
+        # - keep polling the sub-process if it is running
+        # - otherwise sleep until we get a request
+        #
+        if self.commands:
+            return 'spin', data, 0
+
+        return 'spin', data, SAMPLING if data.sub else IDLE
 
     def on(self, data):
 
@@ -362,7 +438,7 @@ class Actor(FSM, Piped):
                     # - reset the sanity check counter
                     # - keep track of its pid to kill it later on
                     #
-                    env = deepcopy(self.env)
+                    env = dict(self.env)
                     env.update(data.env)
                     tokens = data.command if self.shell else data.command.split(' ')
 
@@ -554,15 +630,18 @@ class Actor(FSM, Piped):
             #
             # - we got a request from the leader or the CLI
             # - pile it in the FIFO along with its latch
+            # - wake up to process it
+            # - decode the payload using whatever codec the leader picked
             #
             js = {}
             try:
-                js = json.loads(msg['data'])
+                js = decode(msg['data'], msg.get('type'))
 
             except ValueError:
                 pass
 
             self.commands.append((req, js, msg['latch']))
+            self.wake()
 
         else:
             super(Actor, self).specialized(msg)
@@ -15,36 +15,55 @@
 # limitations under the License.
 #
 import hashlib
-import json
 import logging
 import requests
 import time
 
-from copy import deepcopy
 from kazoo.exceptions import NodeExistsError
 from ochopod.api import Reactive
-from ochopod.core.core import ROOT, SAMPLING
-from ochopod.core.fsm import Aborted, FSM, diagnostic, shutdown
+from ochopod.core import metrics
+from ochopod.core.codec import JSON, negotiate
+from ochopod.core.core import IDLE, ROOT, SAMPLING
+from ochopod.core.fsm import Aborted, Coalesced, FSM, diagnostic, shutdown
+from ochopod.core.record import dumps
+from ochopod.core.snapshot import Writer
 from ochopod.models.piped import _Cluster
 from ochopod.watchers.local import Watcher as Local
 from ochopod.watchers.remote import Watcher as Remote
+from Queue import Queue
 from requests.exceptions import Timeout
 from threading import Thread
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Configuration rounds run by the leader, by outcome.
+ROUNDS = metrics.counter('ochopod_configurations_total', 'configuration rounds run by the leader', ('outcome',))
+
+#: Configuration round duration, by outcome.
+ROUND_TIME = metrics.histogram('ochopod_configuration_seconds', 'configuration round duration', ('outcome',))
+
+#: Number of hash changes absorbed by each successful configuration round (e.g noticed while it was pending).
+ABSORBED = metrics.histogram('ochopod_configuration_changes', 'hash changes absorbed by each configuration round',
+                             buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+#: Duration of each control phase of a configuration round (e.g sending /control/on to all the pods), by task.
+PHASE_TIME = metrics.histogram('ochopod_control_phase_seconds', 'leader control phase duration', ('task',))
+
 
 class _Post(Thread):
     """
     Ancillary actor performing a HTTP POST to send a control request to a pod. We subclass :class:`threading.Thread`
-    to support parallelism.
+    to support parallelism. The payload is encoded with the specified codec (which sets the content type). The
+    optional *done* callable is invoked with a (pod key, HTTP code) tuple once the request completes.
     """
 
-    def __init__(self, key, url, js=None, timeout=60.0):
+    def __init__(self, key, url, js=None, timeout=60.0, codec=JSON, done=None):
         super(_Post, self).__init__()
 
         self.code = None
+        self.codec = codec
+        self.done = done
         self.js = js
         self.key = key
         self.url = url
@@ -59,7 +78,8 @@ class _Post(Thread):
             #   join() with an empty code)
             #
             logger.debug('control -> %s' % self.url)
-            reply = requests.post(self.url, data=json.dumps(self.js), timeout=self.timeout)
+            headers = {'Content-Type': self.codec.content_type}
+            reply = requests.post(self.url, data=self.codec.encode(self.js), headers=headers, timeout=self.timeout)
             self.code = reply.status_code
             logger.debug('control <- %s (HTTP %d)' % (self.url, self.code))
 
@@ -71,6 +91,14 @@ class _Post(Thread):
             #
             logger.debug('control <- %s (timeout)' % self.url)
 
+        finally:
+
+            #
+            # - report back whatever happened (the code is None if we failed to reach the pod)
+            #
+            if self.done:
+                self.done((self.key, self.code))
+
     def join(self, timeout=None):
 
         Thread.join(self)
@@ -83,18 +111,28 @@ class Actor(FSM, Reactive):
     the same Kazoo driver.
     """
 
+    #: Thread class used to send each control request, built from the pod key, the control URL, the json payload,
+    #: a timeout, the codec to encode the payload with and a *done* callable. The thread must invoke *done* with a
+    #: (pod key, HTTP code) tuple once the request completes (the code being None if the pod is unreachable) and its
+    #: join() must return the same tuple. This can be overridden, for instance to route the requests in-process
+    #: when simulating clusters.
+    transport = _Post
+
     def __init__(self, zk, id, hints, scope, tag, port, latch):
         super(Actor, self).__init__()
 
+        self.fingerprints = {}
         self.hints = hints
         self.id = id
         self.latches.append(latch)
         self.path = 'model (reactive)'
         self.port = port
         self.scope = scope
+        self.snapshot = Writer(zk, '%s/%s.%s' % (ROOT, scope, tag))
         self.snapshots = dict.fromkeys(self.depends_on, {})
         self.tag = tag
         self.updated = 0
+        self.updates = Coalesced(self.actor_ref, 'snapshot update')
         self.watchers = []
         self.zk = zk
 
@@ -107,6 +145,7 @@ class Actor(FSM, Reactive):
             shutdown(watcher)
 
         self.hints['status'] = ''
+        self.hints.pop('members', None)
         super(Actor, self).reset(data)
 
     def initial(self, data):
@@ -114,7 +153,7 @@ class Actor(FSM, Reactive):
         #
         # - the /hash node is where we store the md5 hash of all our pods + their dependencies
         # - the /snapshot node is where we store the last known state of our pods (e.g where they run from and what
-        #   their port mapping is)
+        #   their port mapping is), large snapshots being split into compressed shards (see ochopod.core.snapshot)
         #
         try:
             self.zk.create('%s/%s.%s/snapshot' % (ROOT, self.scope, self.tag), value='{}', ephemeral=True)
@@ -127,18 +166,22 @@ class Actor(FSM, Reactive):
         # - this ancillary actor will piggy-back on our zk client and use it to query our pod
         #   information on a regular basis
         #
+        data.changes = 0
         data.dirty = 0
         data.last = None
         data.next_probe = 0
         self.snapshots['local'] = {}
-        self.watchers = [Local.start(self.actor_ref, self.zk, self.scope, self.tag)]
+        self.watchers = [Local.start(self.actor_ref, self.updates, self.zk, self.scope, self.tag)]
 
         #
-        # - add a set of extra watchers for our dependencies
+        # - add one extra watcher multiplexing all our dependencies
         # - make sure to look for clusters within our own namespace
         # - start spinning (the watcher updates will be processed in there)
         #
-        self.watchers += [Remote.start(self.actor_ref, self.zk, self.scope, self.tag, tag) for tag in self.depends_on]
+        if self.depends_on:
+            remote = Remote.start(self.actor_ref, self.updates, self.zk, self.scope, self.tag, self.depends_on)
+            self.watchers.append(remote)
+
         logger.debug('%s : watching %d dependencies' % (self.path, len(self.depends_on)))
         logger.info('%s : leading for cluster %s.%s' % (self.path, self.scope, self.tag))
         return 'spin', data, 0
@@ -177,9 +220,23 @@ class Actor(FSM, Reactive):
                 #
                 logger.info('%s : hash changed, configuration in %2.1f seconds' % (self.path, self.damper))
                 logger.debug('%s : hash -> %s' % (self.path, latest))
+                data.changes = 1
+                data.first = now
                 data.next = now + self.damper
                 data.dirty = 1
 
+            elif bad:
+
+                #
+                # - yet another change while the countdown is on, it will be absorbed by the same configuration
+                # - if the damper is adaptive restart the countdown, without going past the cap
+                #
+                data.changes += 1
+                if self.damper_max > self.damper:
+                    data.next = min(now + self.damper, data.first + self.damper_max)
+                    logger.debug('%s : change #%d, configuration in %2.1f seconds' %
+                                 (self.path, data.changes, data.next - now))
+
             elif not bad:
 
                 #
@@ -188,6 +245,7 @@ class Actor(FSM, Reactive):
                 # - very important -> make sure we set the snapshot (which could have been reset to {})
                 # - don't also forget to set data.last to enable probing
                 #
+                data.changes = 0
                 data.dirty = 0
                 pods = self.snapshots['local']
                 js = \
@@ -198,7 +256,7 @@ class Actor(FSM, Reactive):
 
                 data.last = js
                 data.last['key'] = str(self.id)
-                self.zk.set('%s/%s.%s/snapshot' % (ROOT, self.scope, self.tag), json.dumps(pods))
+                self.snapshot.write(pods)
                 logger.debug('%s : pod update with no hash impact (did we just reconnect to zk ?)' % self.path)
 
         if not data.dirty:
@@ -244,25 +302,35 @@ class Actor(FSM, Reactive):
             #
             # - trigger the configuration procedure
             #
-            self.hints['state'] = 'leader (configuration pending)'
             remaining = max(0, data.next - now)
-            self.hints['status'] = '* configuration in %2.1f seconds' % remaining
+            self.hints.update(
+                {
+                    'state': 'leader (configuration pending)',
+                    'status': '* configuration in %2.1f seconds' % remaining
+                })
             if not remaining:
                 return 'config', data, 0
 
             #
             # - print some cool countdown
+            # - keep ticking until we configure (the status displays the countdown)
             #
             else:
                 logger.debug('%s : configuration in %2.1f seconds' % (self.path, remaining))
+                return 'spin', data, min(SAMPLING, remaining)
 
-        return 'spin', data, SAMPLING
+        #
+        # - sleep until the next probe is due (or until some update wakes us up)
+        #
+        return 'spin', data, min(IDLE, max(0, data.next_probe - now)) if data.last else IDLE
 
     def probe(self, cluster):
         pass
 
     def config(self, data):
 
+        started = time.time()
+        outcome = 'failure'
         try:
 
             #
@@ -272,19 +340,16 @@ class Actor(FSM, Reactive):
             #
             data.last = None
             pods = self.snapshots['local']
-            self.hints['state'] = 'leader (configuring)'
-            self.hints['status'] = '* configuring %d pods' % len(pods)
+            self.hints.update({'state': 'leader (configuring)', 'status': '* configuring %d pods' % len(pods)})
 
             #
             # - map each pod to its full control URL
             # - this will allow us to send requests directly without worrying about remapping the control port
             # - pay attention to order the pod list to guarantee consistent sequencing
             #
-            logger.info('%s : configuring (%d pods, i/o port %d)' % (self.path, len(pods), self.port))
-            ordered = sorted(pods.items())
-            local = str(self.port)
-            urls = \
-                {key: ('http://%s:%d' % (js['ip'], js['ports'][local])) for key, js in ordered if local in js['ports']}
+            logger.info('%s : configuring (%d pods, i/o port %d, %d changes absorbed)' %
+                        (self.path, len(pods), self.port, data.changes))
+            urls = self._urls(pods)
 
             #
             # - they should all expose their control port
@@ -302,91 +367,149 @@ class Actor(FSM, Reactive):
                     'dependencies': {k: v for k, v in self.snapshots.items() if k != 'local'}
                 }
 
-            def _control(task):
+            #
+            # - fingerprint what each pod is configured from (its own registration + our dependencies)
+            #
+            digest = hashlib.md5(dumps(js['dependencies'], sort_keys=True)).hexdigest()
+            fingerprints = {key: (digest, pod) for key, pod in pods.items()}
+
+            def _control(task, targets, accept=None, wait=1):
+                with PHASE_TIME.time(task=task):
+                    return _fan_out(task, targets, accept, wait)
+
+            def _fan_out(task, targets, accept, wait):
+
+                #
+                # - each transport thread pushes its reply (pod key + HTTP code) to our queue as soon as it's done
+                # - this lets us process the replies as they come instead of in order
+                #
                 threads = []
-                for key, url in urls.items():
+                queue = Queue()
+                for key, url in targets.items():
 
                     #
                     # - add the key for each pod
                     # - this json payload will be sent over and turned into a Cluster instance on the other side
+                    # - a shallow copy is enough as the payload is only serialized (the pods are shared)
                     # - inflate the receiving timeout a bit
+                    # - use the most compact codec the pod supports (older pods only speak json)
                     #
-                    payload = deepcopy(js)
-                    payload['key'] = key
+                    payload = dict(js, key=key)
                     seconds = self.grace * 1.25
-                    thread = _Post(key, '%s/control/%s/%d' % (url, task, self.grace), js=payload, timeout=seconds)
+                    thread = self.transport(key, '%s/control/%s/%d' % (url, task, self.grace), js=payload,
+                                            timeout=seconds, codec=negotiate(pods[key]), done=queue.put)
                     threads.append(thread)
 
-                if self.sequential:
+                if not wait:
 
                     #
-                    # - start each HTTP POST thread and join immediately
+                    # - fire & forget, don't wait for the replies
+                    # - make sure the threads don't keep us alive
                     #
-                    def _start_join():
+                    for thread in threads:
+                        thread.daemon = True
                         thread.start()
-                        return thread.join()
 
-                    logger.debug('%s : -> /control/%s (%d pods, sequential)' % (self.path, task, len(pods)))
-                    return [_start_join() for thread in threads]
+                    logger.debug('%s : -> /control/%s (%d pods, not waiting)' % (self.path, task, len(targets)))
+                    return []
 
-                else:
+                replies = []
+                sequential = ' sequential' if self.sequential else ''
+                logger.debug('%s : -> /control/%s (%d pods%s)' % (self.path, task, len(targets), sequential))
+                if not self.sequential:
 
                     #
                     # - start all the HTTP POST threads at once
-                    # - join them one by one
                     #
                     for thread in threads:
                         thread.start()
 
-                    logger.debug('%s : -> /control/%s (%d pods)' % (self.path, task, len(pods)))
-                    return [thread.join() for thread in threads]
+                for thread in threads:
+
+                    #
+                    # - start each thread in turn if sequential
+                    # - pick the next reply
+                    # - abort as soon as a pod replies with a HTTP code we don't accept (there is no point waiting for
+                    #   the slower ones as the outcome is decided) : the remaining threads are simply left running
+                    #
+                    if self.sequential:
+                        thread.start()
+
+                    key, code = queue.get()
+                    replies.append((key, code))
+                    if accept and code not in accept:
+                        logger.debug('%s : /control/%s failed on %s (HTTP %s), aborting' % (self.path, task, key, code))
+                        break
+
+                return replies
 
             #
             # - perform a pre-check, typically to make sure all our dependencies are there
-            # - if this fails for whatever reason we'll postpone the configuration to later
+            # - if this fails for whatever reason we'll postpone the configuration to later (as soon as the first
+            #   failure comes in)
             # - note that any dead pod will fail this test
+            # - always check every pod, even when incremental (this is how dead pods are pruned)
             #
-            replies = _control('check')
+            replies = _control('check', urls, accept=[200, 410])
             dead = [key for key, code in replies if code == 410]
             if dead:
+
+                #
+                # - the snapshots are shared with the watchers and must not be edited
+                # - build a new pod dict instead (which becomes our local snapshot)
+                #
                 logger.warning('%s : dropping %d dead pods' % (self.path, len(dead)))
+                pods = {key: pod for key, pod in pods.items() if key not in dead}
+                self.snapshots['local'] = js['pods'] = pods
                 for key in dead:
-                    del pods[key]
                     del urls[key]
+                    del fingerprints[key]
 
             assert all(code in [200, 410] for _, code in replies), '1+ pods failing the pre-check or unreachable'
-            if pods:
+
+            #
+            # - if incremental, only configure the pods whose fingerprint changed since the last successful
+            #   configuration (e.g new pods or every pod if the dependencies changed)
+            # - the others are left untouched (which is what they would do anyway when not strict)
+            #
+            targets = urls
+            if self.incremental and not self.full_shutdown:
+                targets = {key: url for key, url in urls.items() if self.fingerprints.get(key) != fingerprints[key]}
+                if len(targets) < len(urls):
+                    logger.info('%s : %d pods unchanged, skipping them' % (self.path, len(urls) - len(targets)))
+
+            if targets:
 
                 #
-                # - we have at least one pod alive
+                # - we have at least one pod alive (and to configure)
                 # - if a full shutdown has been requested start by sending a /off to each pod in order
                 #
                 if self.full_shutdown:
-                    _control('off')
+                    _control('off', targets)
 
                 #
                 # - send a /on to each pod in order to configure and (re-)start them
                 # - note we include an extra 'index' integer to the payload passed to the pod (this index
                 #   can be used to tag the pod in logs or perform specific setup procedures)
                 #
-                logger.debug('%s : json payload ->\n%s' % (self.path, json.dumps(js, indent=4, separators=(',', ': '))))
-                logger.info('%s : asking %d pods to configure' % (self.path, len(pods)))
-                replies = _control('on')
+                logger.debug('%s : json payload ->\n%s' % (self.path, dumps(js, indent=4, separators=(',', ': '))))
+                logger.info('%s : asking %d pods to configure' % (self.path, len(targets)))
+                replies = _control('on', targets, accept=[200])
                 assert all(code == 200 for _, code in replies), '1+ pods failing to configure or unreachable'
 
                 #
                 # - operation successful -> ask each pod to run its configured() callback
-                # - just fire & forget
+                # - just fire & forget (we don't wait for the replies), unless sequential in which case the pods must
+                #   run it one after the other (and before we publish the new hash)
                 #
-                _control('ok')
+                _control('ok', targets, wait=self.sequential)
 
             #
             # - in any case update the md5 hash
             # - update also our /snapshot node (which will propagate if this cluster is a dependency for somebody else)
             #
             latest = self._md5()
-            local = json.dumps(pods)
-            self.zk.set('%s/%s.%s/snapshot' % (ROOT, self.scope, self.tag), local)
+            self.snapshot.write(pods)
             self.zk.set('%s/%s.%s/hash' % (ROOT, self.scope, self.tag), latest)
             logger.debug('%s : new hash -> %s' % (self.path, latest))
             logger.info('%s : configuration complete (%d pods alive)' % (self.path, len(pods)))
@@ -396,22 +519,33 @@ class Actor(FSM, Reactive):
             # - keep track of the cluster description
             # - go back to spinning & force a call to probe() right away
             #
+            ABSORBED.observe(data.changes)
+            self.fingerprints = fingerprints
+            data.changes = 0
             data.dirty = 0
             data.last = js
             data.last['key'] = str(self.id)
             data.next_probe = 0
+            outcome = 'success'
 
         except AssertionError as failure:
 
             #
             # - any assert aborts the procedure
-            # - leave the trigger on and reset the timestamp to re-attempt
+            # - leave the trigger on and reset the timestamp to re-attempt (which also restarts the adaptive damper
+            #   window)
             #
             logger.warn('%s : configuration failed -> %s' % (self.path, diagnostic(failure)))
             self.hints['state'] = 'leader (configuration pending)'
-            data.next = time.time() + self.damper
+            data.first = time.time()
+            data.next = data.first + self.damper
             data.last = None
 
+        finally:
+
+            ROUNDS.inc(outcome=outcome)
+            ROUND_TIME.observe(time.time() - started, outcome=outcome)
+
         return 'spin', data, SAMPLING
 
     def specialized(self, msg):
@@ -421,13 +555,21 @@ class Actor(FSM, Reactive):
         if req == 'snapshot update':
 
             #
-            # - a snapshot changed value (either us or some dependency)
+            # - one or more snapshots changed value (either us or some dependency)
+            # - drain the coalesced updates (e.g only the latest snapshot for each key is kept)
             # - update our snapshot dict
             # - set the trigger to force a comparison against the last recorded hash
+            # - wake up to process it
+            #
+            for key, pods in self.updates.drain().items():
+                self.snapshots[key] = pods
+                self.updated = 1
+
+            #
+            # - publish the control URL of each pod in our cluster (this is what /cluster/info fans out to)
             #
-            key = msg['key']
-            self.snapshots[key] = msg['pods']
-            self.updated = 1
+            self.hints['members'] = self._urls(self.snapshots['local'])
+            self.wake()
 
         elif req == 'watcher failure':
 
@@ -437,16 +579,27 @@ class Actor(FSM, Reactive):
             #
             logger.debug('%s : watcher failure, terminating' % self.path)
             self.terminate = 1
+            self.wake()
 
         else:
             super(Actor, self).specialized(msg)
 
+    def _urls(self, pods):
+
+        #
+        # - map each pod to its full control URL (skipping any pod not exposing our control port)
+        #
+        local = str(self.port)
+        return \
+            {key: 'http://%s:%d' % (js['ip'], js['ports'][local]) for key, js in pods.items() if local in js['ports']}
+
     def _md5(self):
 
         #
         # - compute the MD5 of our snapshots serialized to json
+        # - sort the keys to make sure the outcome does not depend on how the pod records are laid out
         # - return something that's readable
         #
         hashed = hashlib.md5()
-        hashed.update(json.dumps(self.snapshots))
+        hashed.update(dumps(self.snapshots, sort_keys=True))
         return ':'.join(c.encode('hex') for c in hashed.digest())
\ No newline at end of file
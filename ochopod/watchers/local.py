@@ -14,14 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import json
 import logging
 import pykka
 
-from copy import deepcopy
 from kazoo.exceptions import NoNodeError
-from ochopod.core.core import ROOT, SAMPLING
+from ochopod.core.codec import decode
+from ochopod.core.core import IDLE, ROOT
 from ochopod.core.fsm import Aborted, FSM
+from ochopod.core.record import PodRecord
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
@@ -29,16 +29,18 @@ logger = logging.getLogger('ochopod')
 
 class Watcher(FSM):
     """
-    Ancillary actor whose job is to flag updates to our local snapshot by querying & comparing.
+    Ancillary actor whose job is to flag updates to our local snapshot by querying & comparing. The pods are
+    watched : we only query again when zk notifies us that some pod came, went or changed.
     """
 
-    def __init__(self, model, zk, scope, tag):
+    def __init__(self, model, updates, zk, scope, tag):
         super(Watcher, self).__init__()
 
         self.model = model
         self.path = 'watcher (%s.%s)' % (scope, tag)
         self.scope = scope
         self.tag = tag
+        self.updates = updates
         self.zk = zk
 
     def reset(self, data):
@@ -60,6 +62,7 @@ class Watcher(FSM):
         # - go straight to spinning
         #
         data.latest = None
+        data.parsed = {}
         return 'spin', data, 0
 
     def spin(self, data):
@@ -73,28 +76,70 @@ class Watcher(FSM):
         #
         # - query our /pods/* nodes
         # - split the pod UUID and the sequence counter
-        # - concatenate into one dict
+        # - decode each payload (whatever its codec) into a compact pod record and concatenate into one dict
         # - store the sequence counter as 'index'
+        # - re-use the payload we parsed last time if the node value did not change : unchanged pods are
+        #   therefore shared as-is from one snapshot to the next
+        # - leave a watch on /pods and on each pod node (the breadcrumbs are set right after the node is created)
+        # - skip any pod that went away in the meantime (we'll be notified anyway)
         #
         pods = {}
+        parsed = {}
         prefix = '%s/%s.%s' % (ROOT, self.scope, self.tag)
-        for pod in [tag for tag in self.zk.get_children('%s/pods' % prefix)]:
-            (value, stat) = self.zk.get('%s/pods/%s' % (prefix, pod))
+        for pod in self.zk.get_children('%s/pods' % prefix, watch=self.feedback):
+            try:
+                (value, stat) = self.zk.get('%s/pods/%s' % (prefix, pod), watch=self.feedback)
+
+            except NoNodeError:
+                continue
+
+            #
+            # - the pod node is created first and its breadcrumbs set right after : skip it until then
+            #
+            if not value:
+                continue
+
             tokens = pod.split('.')
-            js = json.loads(value)
-            pods[tokens[0]] = js
+            last = data.parsed.get(pod)
+            record = last[1] if last and last[0] == value else PodRecord(decode(value))
+            parsed[pod] = value, record
+            pods[tokens[0]] = record
 
         #
-        # - if we differ with our last snapshot, notify the model
-        # - don't forget to copy the js payload as the receiving actor may edit it
+        # - if we differ with our last snapshot, notify the model (the updates are coalesced in its mailbox)
+        # - the snapshot is never copied : it is immutable once posted and the receiving actor must not edit it
         #
+        data.parsed = parsed
         if pods != data.latest:
             data.latest = pods
-            self.model.tell(
-                {
-                    'request': 'snapshot update',
-                    'key': 'local',
-                    'pods': deepcopy(pods)
-                })
-
-        return 'spin', data, SAMPLING
+            self.updates.post('local', pods)
+
+        return 'spin', data, IDLE
+
+    def specialized(self, msg):
+
+        assert 'request' in msg, 'bogus message received ?'
+        req = msg['request']
+
+        if req == 'watch triggered':
+
+            #
+            # - a zk watch was activated, wake up and query again
+            # - the watches will then be reset
+            #
+            self.wake()
+
+        else:
+            super(Watcher, self).specialized(msg)
+
+    def feedback(self, event):
+
+        #
+        # - watch notification from the zk client
+        # - forward to the actor along with the node path
+        #
+        self.actor_ref.tell(
+            {
+                'request': 'watch triggered',
+                'path': event.path
+            })
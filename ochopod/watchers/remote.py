@@ -15,12 +15,11 @@
 # limitations under the License.
 #
 import fnmatch
-import json
 import logging
 
-from kazoo.exceptions import NoNodeError
-from ochopod.core.core import ROOT, SAMPLING
+from ochopod.core.core import IDLE, ROOT
 from ochopod.core.fsm import Aborted, FSM
+from ochopod.core.snapshot import Reader
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
@@ -28,19 +27,22 @@ logger = logging.getLogger('ochopod')
 
 class Watcher(FSM):
     """
-    Ancillary actor whose job is to flag updates to a given zk node using a watch. We use this mechanism
-    to keep track of the pod dependencies.
+    Ancillary actor whose job is to flag updates to our dependencies using zk watches. One single watcher is
+    multiplexing all the dependencies : each snapshot node is read and watched once (even if it matches several
+    dependencies, e.g 'db.*' and 'db.primary') and any change is fanned out to the dependencies it maps to.
     """
 
-    def __init__(self, model, zk, scope, tag, remote):
+    def __init__(self, model, updates, zk, scope, tag, remotes):
         super(Watcher, self).__init__()
 
+        self.children = 1
         self.model = model
-        self.path = 'watcher (%s.%s)' % (scope, tag)
+        self.path = 'watcher (%s.%s, %d dependencies)' % (scope, tag, len(remotes))
+        self.pending = set()
         self.pod = '%s.%s' % (scope, tag)
-        self.query = 1
-        self.remote = remote
+        self.remotes = remotes
         self.scope = scope
+        self.updates = updates
         self.zk = zk
 
     def reset(self, data):
@@ -59,9 +61,17 @@ class Watcher(FSM):
     def initial(self, data):
 
         #
+        # - any dependency starting with '/' is absolute
+        # - the lookup will be done starting in the pod's namespace otherwise
         # - go straight to spinning
         #
-        data.latest = None
+        data.cache = {}
+        data.latest = {}
+        data.matches = {}
+        data.used = set()
+        data.reader = Reader(self.zk)
+        data.patterns = {remote: remote[1:] if remote[0] == '/' else '%s.%s' % (self.scope, remote)
+                         for remote in self.remotes}
         return 'spin', data, 0
 
     def spin(self, data):
@@ -72,96 +82,73 @@ class Watcher(FSM):
         if self.terminate:
             self.exitcode()
 
-        if self.query:
+        if self.children:
 
             #
-            # - the flip-flop trigger is on
-            # - go get to the zk nodes we want to look at
-            # - any dependency starting with '/' is absolute
-            # - the lookup will be done starting in the pod's namespace otherwise
+            # - the flip-flop trigger for the root is on (e.g this is the first pass or some cluster came or went)
+            # - map each dependency to the clusters it resolves to
+            # - from @pferro -> leave a watch on the ROOT in case a new node matching a wildcard appears later on
+            #   (only do so if at least one dependency uses a wildcard)
+            # - do *not* include the current pod, this edge case could be hit when using absolute dependencies
             #
-            pods = {}
-            where = self.remote[1:] if self.remote[0] == '/' else '%s.%s' % (self.scope, self.remote)
-            if '*' in self.remote:
-
-                #
-                # - regex dependency, which is slightly more involved
-                # - from @pferro -> leave a watch on the ROOT in case a new node matching
-                #   the regex appears later on
-                # - each zk node matching the regex will also leave a watch on
-                #
-                for child in self.zk.get_children(ROOT, watch=self.feedback):
-                    if fnmatch.fnmatch(child, where):
-                        try:
-
-                            #
-                            # - do *not* include the current pod in the watch
-                            # - this edge case could be hit when using absolute dependencies
-                            #
-                            if child == self.pod:
-                                continue
-
-                            #
-                            # - same as the regular case: grab the json payload and leave a watch
-                            # - from @pferro -> we need to make sure we leave a watch around in case the
-                            #   snapshot node does not exist yet (the regular case does not require it since
-                            #   the self.query flip-flop would be left on by default)
-                            #
-                            path = '%s/%s/snapshot' % (ROOT, child)
-                            if self.zk.exists(path, watch=self.feedback):
-                                value, stat = self.zk.get(path, watch=self.feedback)
-                                try:
-                                    pods.update(json.loads(value))
-                                except ValueError:
-                                    pass
-
-                        except NoNodeError:
-                            pass
-
-                #
-                # - unset the flip-flop
-                #
-                self.query = 0
+            self.children = 0
+            wildcards = [remote for remote, where in data.patterns.items() if '*' in where]
+            children = self.zk.get_children(ROOT, watch=self.feedback) if wildcards else []
+            for remote, where in data.patterns.items():
+                if remote in wildcards:
+                    data.matches[remote] = \
+                        [child for child in children if fnmatch.fnmatch(child, where) and child != self.pod]
+                else:
+                    data.matches[remote] = [where] if where != self.pod else []
 
-            else:
+            #
+            # - read any cluster we are not tracking yet
+            # - drop the ones we do not care about anymore
+            #
+            data.used = set(cluster for clusters in data.matches.values() for cluster in clusters)
+            self.pending |= data.used - set(data.cache.keys())
+            for cluster in set(data.cache.keys()) - data.used:
+                del data.cache[cluster]
+                data.reader.forget('%s/%s' % (ROOT, cluster))
+
+        while self.pending:
+
+            #
+            # - read each snapshot node that either changed or was never read (only the shards that changed are
+            #   fetched for large snapshots)
+            # - from @pferro -> we need to make sure we leave a watch around in case the snapshot node does
+            #   not exist yet (e.g the dependency has no leader yet or the dependency path is invalid)
+            # - a given snapshot node is watched only once, whatever the number of dependencies it matches
+            # - keep what we had if the snapshot got replaced while we were reading it (the watch will fire)
+            #
+            cluster = self.pending.pop()
+            if cluster not in data.used:
+                continue
+
+            pods = data.reader.read('%s/%s' % (ROOT, cluster), watch=self.feedback)
+            if pods is not None:
+                data.cache[cluster] = pods
 
-                #
-                # - no regex specified -> simply do a single get() on the appropriate zk node
-                # - issue a get() on the dependency snapshot/ node
-                # - if this node is not there yet (or the dependency path invalid), no big deal
-                #
-                try:
-                    if where != self.pod:
-                        path = '%s/%s/snapshot' % (ROOT, where)
-                        value, stat = self.zk.get(path, watch=self.feedback)
-                        try:
-                            pods.update(json.loads(value))
-                        except ValueError:
-                            pass
-
-                    #
-                    # - unset the flip-flop
-                    #
-                    self.query = 0
-
-                except NoNodeError:
-                    pass
+        for remote, clusters in data.matches.items():
 
             #
-            # - notify the model we have a snapshot for that dependency
+            # - fan the snapshots out to each dependency
+            # - notify the model if it changed (the updates are coalesced in its mailbox)
             #
-            if pods != data.latest:
-                data.latest = pods
-                logger.debug('%s : change detected in dependency' % self.path)
-                self.model.tell(
-                    {
-                        'request': 'snapshot update',
-                        'key': self.remote,
-                        'pods': pods
-                    })
-
-        return 'spin', data, SAMPLING
-    
+            pods = {}
+            for cluster in clusters:
+                pods.update(data.cache.get(cluster, {}))
+
+            if remote not in data.latest or pods != data.latest[remote]:
+                data.latest[remote] = pods
+                logger.debug('%s : change detected in dependency %s' % (self.path, remote))
+                self.updates.post(remote, pods)
+
+        #
+        # - sleep until a watch is triggered
+        #
+        return 'spin', data, IDLE
+
     def specialized(self, msg):
 
         assert 'request' in msg, 'bogus message received ?'
@@ -170,12 +157,19 @@ class Watcher(FSM):
         if req == 'watch triggered':
 
             #
-            # - the zk watch was activated
-            # - simply set the flip-flop which will result in a new get()
+            # - a zk watch was activated
+            # - either flag the root (e.g re-resolve our wildcards) or the snapshot node to read again
             # - the watch will then be reset again on the node
+            # - wake up to process it
             #
-            self.query = 1
-            
+            path = msg['path']
+            if path == ROOT:
+                self.children = 1
+            else:
+                self.pending.add(path[len(ROOT) + 1:].split('/')[0])
+
+            self.wake()
+
         else:
             super(Watcher, self).specialized(msg)
 
@@ -183,9 +177,10 @@ class Watcher(FSM):
 
         #
         # - watch notification from the zk client
-        # - forward to the actor
+        # - forward to the actor along with the node path
         #
         self.actor_ref.tell(
             {
-                'request': 'watch triggered'
+                'request': 'watch triggered',
+                'path': event.path
             })